@@ -1,5 +1,6 @@
 import shlex
 import sys
+
 from shared.intervaltree.intervaltree import IntervalTree
 
 from shared.utils import subprocess_popen
@@ -77,6 +78,41 @@ def bed_tree_from(bed_file_path,
     return tree
 
 
+def interval_at(tree, contig_name, region_start):
+    """
+    Return one (begin, end) interval covering region_start, or None when no
+    interval covers it. Lets callers cache the surrounding interval so
+    consecutive nearby positions skip the tree query.
+    """
+    if not tree or (contig_name is None) or (contig_name not in tree):
+        return None
+    intervals = tree[contig_name].at(region_start)
+    if not intervals:
+        return None
+    interval = next(iter(intervals))
+    return interval.begin, interval.end
+
+
+def region_mask_from(tree, contig_name, mask_start, mask_end):
+    """
+    Materialize the tree's intervals over [mask_start, mask_end] as a bytearray
+    indexed by pos - mask_start. bool(mask[pos - mask_start]) equals
+    is_region_in(tree, contig_name, pos - 1, pos + 1), the per-row membership
+    query, so a hot loop pays one indexed load instead of a tree lookup. A
+    bytearray keeps the module importable under pypy3, where numpy is absent.
+    """
+    mask = bytearray(mask_end - mask_start + 2)
+    if not tree or (contig_name is None) or (contig_name not in tree):
+        return mask
+    for interval in tree[contig_name]:
+        # overlap(pos - 1, pos + 1) covers pos in [begin, end] inclusive
+        begin = max(interval.begin, mask_start)
+        end = min(interval.end, mask_end)
+        if end >= begin:
+            mask[begin - mask_start: end - mask_start + 1] = b'\x01' * (end - begin + 1)
+    return mask
+
+
 def is_region_in(tree, contig_name, region_start=None, region_end=None):
     if not tree or (contig_name is None) or (contig_name not in tree):
         return False
@@ -1,15 +1,45 @@
+import io
 import os
 
 from collections import defaultdict
+from functools import lru_cache
+from queue import Queue
+from threading import Thread
 from os.path import abspath
+import shutil
 from sys import exit, stderr
-from subprocess import check_output, PIPE, Popen
+from subprocess import PIPE, Popen
 import argparse
 import shlex
 from subprocess import PIPE
 from os.path import isfile, isdir
 from textwrap import dedent
 
+try:
+    import rapidgzip
+except ModuleNotFoundError:
+    rapidgzip = None
+
+try:
+    import pysam
+except ModuleNotFoundError:
+    pysam = None
+
+try:
+    import pyfaidx
+except ModuleNotFoundError:
+    pyfaidx = None
+
+try:
+    import pyzstd
+except ModuleNotFoundError:
+    pyzstd = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 IUPAC_base_to_ACGT_base_dict = dict(zip(
     "ACGTURYSWKMBDHVN",
     ("A", "C", "G", "T", "T", "A", "C", "C", "A", "G", "A", "C", "A", "A", "A", "A")
@@ -54,42 +84,38 @@ def file_path_from(file_name, suffix="", exit_on_not_found=False, sep="", allow_
     if allow_none and file_name is None:
         return None
     if is_directory:
-        is_folder_exists(file_name, suffix)
         if exit_on_not_found:
             exit(log_error("[ERROR] directory %s not found" % (file_name + suffix)))
-    if is_file_exists(file_name, suffix):
-        return abspath(file_name + suffix)
+    file_path = file_name + suffix if isinstance(file_name, str) and isinstance(suffix, str) else None
+    if file_path is not None and isfile(file_path):
+        return abspath(file_path)
     #allow fn.bam.bai->fn.bai fn.fa.fai->fn.fai
     elif sep != "" and len(sep) == 1:
-        file_name_remove_suffix = sep.join(file_name.split(sep)[:-1])
-        if is_file_exists(file_name_remove_suffix, suffix):
-            return abspath(file_name_remove_suffix + suffix)
+        file_path_remove_suffix = sep.join(file_name.split(sep)[:-1]) + suffix
+        if isfile(file_path_remove_suffix):
+            return abspath(file_path_remove_suffix)
     if exit_on_not_found:
         exit(log_error("[ERROR] file %s not found" % (file_name + suffix)))
     return None
 
 def folder_path_from(folder_name, create_not_found=True, exit_on_not_found=False):
+    absolute_folder_path = abspath(folder_name) if isinstance(folder_name, str) else None
     if is_folder_exists(folder_name):
-        return abspath(folder_name)
+        return absolute_folder_path
     if exit_on_not_found:
         exit(log_error("[ERROR] folder %s not found" % (folder_name)))
     if create_not_found:
         if not os.path.exists(folder_name):
-            os.makedirs(abspath(folder_name), exist_ok=True)
+            os.makedirs(absolute_folder_path, exist_ok=True)
             print("[INFO] Create folder %s" % (folder_name), file=stderr)
-            return abspath(folder_name)
+            return absolute_folder_path
     return None
 
 
 def is_command_exists(command):
     if not isinstance(command, str):
         return False
-
-    try:
-        check_output("which %s" % (command), shell=True)
-        return True
-    except:
-        return False
+    return shutil.which(command) is not None
 
 
 def executable_command_string_from(command_to_execute, exit_on_not_found=False):
@@ -100,8 +126,154 @@ def executable_command_string_from(command_to_execute, exit_on_not_found=False):
     return None
 
 
-def subprocess_popen(args, stdin=None, stdout=PIPE, stderr=stderr, bufsize=8388608):
-    return Popen(args, stdin=stdin, stdout=stdout, stderr=stderr, bufsize=bufsize, universal_newlines=True)
+def subprocess_popen(args, stdin=None, stdout=PIPE, stderr=stderr, bufsize=8388608, text=True):
+    # pass text=False for high-throughput pipes to skip the per-line decode
+    return Popen(args, stdin=stdin, stdout=stdout, stderr=stderr, bufsize=bufsize, universal_newlines=text)
+
+
+def widen_pipe_buffer(stream, size=1 << 20):
+    """
+    Grow a pipe buffer beyond the 64KB Linux default so a fast producer such as
+    samtools mpileup stalls less often waiting for the consumer. Best effort:
+    silently keeps the default on platforms or kernels that refuse the resize.
+    """
+    if fcntl is None or stream is None:
+        return
+    try:
+        fcntl.fcntl(stream.fileno(), getattr(fcntl, 'F_SETPIPE_SZ', 1031), size)
+    except (OSError, ValueError):
+        pass
+
+
+def batched_line_generator_from(stream, chunk_size=1 << 20):
+    """
+    Yield decoded lines from a binary stream read in large chunks, avoiding the
+    per-line readline and newline-translation overhead of a text-mode pipe on
+    multi-million-row streams such as samtools mpileup output.
+    """
+    tail = b''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        lines = (tail + chunk).split(b'\n')
+        tail = lines.pop()
+        for line in lines:
+            yield line.decode('ascii')
+    if tail:
+        yield tail.decode('ascii')
+
+
+def threaded_batched_line_generator_from(stream, chunk_size=1 << 20, maxsize=8):
+    """
+    Same line stream as batched_line_generator_from, with the blocking pipe
+    reads and the ascii decode moved to a background thread behind a bounded
+    queue, so the writing subprocess and the consuming parser overlap instead
+    of taking turns on the pipe.
+    """
+    batch_queue = Queue(maxsize=maxsize)
+
+    def produce():
+        try:
+            tail = b''
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                lines = (tail + chunk).split(b'\n')
+                tail = lines.pop()
+                if lines:
+                    batch_queue.put([line.decode('ascii') for line in lines])
+            if tail:
+                batch_queue.put([tail.decode('ascii')])
+            batch_queue.put(None)
+        except Exception as e:
+            batch_queue.put(e)
+
+    Thread(target=produce, daemon=True).start()
+    while True:
+        batch = batch_queue.get()
+        if batch is None:
+            return
+        if isinstance(batch, Exception):
+            raise batch
+        for line in batch:
+            yield line
+
+
+class _ZstdWriter(object):
+    """
+    In-process zstd text writer exposing the same .stdin/.wait() surface as the
+    `zstd -c` subprocess it replaces, so the writer shutdown code stays shared.
+    """
+    def __init__(self, output_path, level=3, nb_workers=2):
+        self.stdin = io.TextIOWrapper(pyzstd.ZstdFile(
+            output_path, 'wb',
+            level_or_option={pyzstd.CParameter.compressionLevel: level,
+                             pyzstd.CParameter.nbWorkers: nb_workers}))
+
+    def wait(self):
+        if not self.stdin.closed:
+            self.stdin.close()
+
+
+def zstd_writer_from(output_path, zstd_bin):
+    """
+    Open a zstd-compressed text writer, in-process through pyzstd when it is
+    installed (no pipe copy, threaded compression), otherwise piped through a
+    zstd subprocess. Returns (writer, output handle) matching the subprocess
+    convention at the call sites.
+    """
+    if pyzstd is not None:
+        writer = _ZstdWriter(output_path)
+        return writer, writer.stdin
+    fpo = open(output_path, "wb")
+    return subprocess_popen(shlex.split("{} -c".format(zstd_bin)), stdin=PIPE, stdout=fpo), fpo
+
+
+def _is_gzip_file(file_path):
+    # the two gzip magic bytes, so plain files keep the `gzip -fdc` passthrough
+    with open(file_path, 'rb') as fp:
+        return fp.read(2) == b'\x1f\x8b'
+
+
+def gzip_byte_lines_from(file_path, chunk_size=1 << 20):
+    """
+    Yield the byte lines of a plain or gzip-compressed file. The decompressed
+    stream is read in large chunks and split on newlines, instead of paying a
+    per-line read and text decode.
+    """
+    if rapidgzip is not None and _is_gzip_file(file_path):
+        fh = rapidgzip.open(file_path, parallelization=os.cpu_count())
+        unzip_process = None
+    else:
+        unzip_process = Popen(shlex.split("gzip -fdc %s" % (file_path)), stdout=PIPE, bufsize=chunk_size)
+        fh = unzip_process.stdout
+    remainder = b''
+    for chunk in iter(lambda: fh.read(chunk_size), b''):
+        lines = (remainder + chunk).split(b'\n')
+        remainder = lines[-1]
+        for row in lines[:-1]:
+            yield row
+    if remainder:
+        yield remainder
+    fh.close()
+    if unzip_process is not None:
+        unzip_process.wait()
+
+
+def gzip_bytes_from(file_path):
+    """
+    Read the full decompressed content of a plain or gzip-compressed file as bytes.
+    """
+    if rapidgzip is not None and _is_gzip_file(file_path):
+        with rapidgzip.open(file_path, parallelization=os.cpu_count()) as fh:
+            return fh.read()
+    unzip_process = Popen(shlex.split("gzip -fdc %s" % (file_path)), stdout=PIPE, bufsize=8388608)
+    data = unzip_process.stdout.read()
+    unzip_process.stdout.close()
+    unzip_process.wait()
+    return data
 
 
 def str_none(v):
@@ -112,14 +284,17 @@ def str_none(v):
     if isinstance(v, str):
         return v
 
+_TRUE_STRING_SET = frozenset(('yes', 'ture', 'true', 't', 'y', '1'))
+_FALSE_STRING_SET = frozenset(('no', 'flase', 'false', 'f', 'n', '0'))
+
 def str2bool(v):
     if v is None:
         return v
     if isinstance(v, bool):
        return v
-    if v.lower() in ('yes', 'ture', 'true', 't', 'y', '1'):
+    if v.lower() in _TRUE_STRING_SET:
         return True
-    elif v.lower() in ('no', 'flase', 'false', 'f', 'n', '0'):
+    elif v.lower() in _FALSE_STRING_SET:
         return False
     else:
         raise argparse.ArgumentTypeError('Boolean value expected.')
@@ -137,48 +312,92 @@ def region_from(ctg_name, ctg_start=None, ctg_end=None):
         return "{}".format(ctg_name)
     return "{}:{}-{}".format(ctg_name, ctg_start, ctg_end)
 
+_ASCII_UPPER_TABLE = bytes.maketrans(b'abcdefghijklmnopqrstuvwxyz', b'ABCDEFGHIJKLMNOPQRSTUVWXYZ')
+
+
+_fasta_handle_cache = {}
+
+
+def _fasta_handle_from(fasta_file_path):
+    # one mmap-backed handle per fasta, reused across chunk calls
+    handle = _fasta_handle_cache.get(fasta_file_path)
+    if handle is None:
+        handle = pyfaidx.Fasta(fasta_file_path, rebuild=False)
+        _fasta_handle_cache[fasta_file_path] = handle
+    return handle
+
+
 def reference_sequence_from(samtools_execute_command, fasta_file_path, regions):
-    refernce_sequences = []
+    if pyfaidx is not None:
+        # indexed access avoids a samtools faidx fork/exec and pipe per chunk
+        try:
+            fasta = _fasta_handle_from(fasta_file_path)
+            reference_sequences = []
+            for region in regions:
+                if ':' in region:
+                    ctg_name, start_end = region.split(':')
+                    ctg_start, ctg_end = start_end.split('-')
+                    # 1-based inclusive region to 0-based slice
+                    reference_sequences.append(fasta[ctg_name][int(ctg_start) - 1: int(ctg_end)].seq)
+                else:
+                    reference_sequences.append(fasta[region][:].seq)
+            return "".join(reference_sequences).upper()
+        except (KeyError, ValueError, IOError, pyfaidx.FastaIndexingError, pyfaidx.FetchError):
+            pass
+
     region_value_for_faidx = " ".join(regions)
 
-    samtools_faidx_process = subprocess_popen(
-        shlex.split("{} faidx {} {}".format(samtools_execute_command, fasta_file_path, region_value_for_faidx))
+    # binary pipe, sequence lines ">xxxx" name lines need to be ignored
+    samtools_faidx_process = Popen(
+        shlex.split("{} faidx {} {}".format(samtools_execute_command, fasta_file_path, region_value_for_faidx)),
+        stdout=PIPE, stderr=stderr, bufsize=8388608
     )
-    while True:
-        row = samtools_faidx_process.stdout.readline()
-        is_finish_reading_output = row == '' and samtools_faidx_process.poll() is not None
-        if is_finish_reading_output:
-            break
-        if row:
-            refernce_sequences.append(row.rstrip())
-
-    # first line is reference name ">xxxx", need to be ignored
-    reference_sequence = "".join(refernce_sequences[1:])
-
-    # uppercase for masked sequences
-    reference_sequence = reference_sequence.upper()
+    reference_sequence = bytearray()
+    for row in samtools_faidx_process.stdout:
+        if not row.startswith(b'>'):
+            reference_sequence.extend(row.rstrip())
 
     samtools_faidx_process.stdout.close()
     samtools_faidx_process.wait()
     if samtools_faidx_process.returncode != 0:
         return None
 
-    return reference_sequence
+    # uppercase for masked sequences, a single C pass over the buffer
+    return reference_sequence.translate(_ASCII_UPPER_TABLE).decode('ascii')
 
 def vcf_candidates_from(vcf_fn, contig_name=None):
 
     known_variants_set = set()
-    unzip_process = subprocess_popen(shlex.split("gzip -fdc %s" % (vcf_fn)))
+
+    # with a tabix/CSI index the contig block is reachable by a BGZF seek,
+    # no need to decompress the whole file
+    if pysam is not None and contig_name and \
+            (is_file_exists(vcf_fn, '.tbi') or is_file_exists(vcf_fn, '.csi')):
+        variant_file = pysam.VariantFile(vcf_fn)
+        try:
+            for record in variant_file.fetch(contig_name):
+                known_variants_set.add(record.pos)
+        except ValueError:
+            pass
+        variant_file.close()
+        return sorted(known_variants_set)
+
+    target_ctg = contig_name.encode() if contig_name else None
 
     start_pos, end_pos = float('inf'), 0
-    for row in unzip_process.stdout:
-        if row[0] == '#':
+    seen_target_ctg = False
+    for row in gzip_byte_lines_from(vcf_fn):
+        if not row or row[:1] == b'#':
             continue
-        columns = row.strip().split(maxsplit=3)
+        columns = row.split(maxsplit=3)
         ctg_name = columns[0]
 
-        if contig_name and ctg_name != contig_name:
+        if target_ctg is not None and ctg_name != target_ctg:
+            # VCFs are contig-sorted, stop once past the target block
+            if seen_target_ctg:
+                break
             continue
+        seen_target_ctg = True
         center_pos = int(columns[1])
         known_variants_set.add(center_pos)
         start_pos = min(start_pos, center_pos)
@@ -227,10 +446,15 @@ def samtools_view_process_from(
     region_str = ("%s:%d-%d" % (ctg_name, ctg_start, ctg_end)) if have_start_and_end_position else ctg_name
 
     return subprocess_popen(
-        shlex.split("%s view -F 2318 %s %s" % (samtools, bam_file_path, region_str))
+        shlex.split("%s view -F 2318 %s %s" % (samtools, bam_file_path, region_str)), text=False
     )
 
 class Position(object):
+    __slots__ = ('ctg_name', 'pos', 'reference_bases', 'candidate', 'alternate_bases', 'start', 'end',
+                 'genotype1', 'genotype2', 'genotype', 'cigar_count', 'confident_variant', '_read_name_set',
+                 'depth', '_variant_hap_dict', 'phased_genotype', '_hap_count_dict', 'alt_list', 'extra_infos',
+                 'filter', 'af', 'qual', 'row_str')
+
     def __init__(self, ctg_name=None,
                  genotype1=None,
                  genotype2=None,
@@ -264,20 +488,43 @@ class Position(object):
         self.genotype1 = genotype1
         self.genotype2 = genotype1
         self.genotype = [genotype1, genotype2]
-        self.genotype_str = str(genotype1) + '/' + str(genotype2)
         self.cigar_count = cigar_count
         self.confident_variant = confident_variant
-        self.read_name_set = set()
+        # phasing containers are created on first access, most sites never use them
+        self._read_name_set = None
         self.depth = depth
-        self.variant_hap_dict = defaultdict(defaultdict)
+        self._variant_hap_dict = None
         self.phased_genotype = None
-        self.hap_count_dict = defaultdict(int)
+        self._hap_count_dict = None
         self.alt_list = alt_list
         self.extra_infos = extra_infos
         self.filter = filter
         self.af = af
         self.qual = qual
         self.row_str = row_str
+
+    @property
+    def genotype_str(self):
+        return str(self.genotype[0]) + '/' + str(self.genotype[1])
+
+    @property
+    def read_name_set(self):
+        if self._read_name_set is None:
+            self._read_name_set = set()
+        return self._read_name_set
+
+    @property
+    def variant_hap_dict(self):
+        if self._variant_hap_dict is None:
+            self._variant_hap_dict = defaultdict(defaultdict)
+        return self._variant_hap_dict
+
+    @property
+    def hap_count_dict(self):
+        if self._hap_count_dict is None:
+            self._hap_count_dict = defaultdict(int)
+        return self._hap_count_dict
+
     def update_info(self, ref_base, alt_base, genotype, extra_infos=""):
         self.reference_bases = ref_base
         self.alternate_bases = alt_base
@@ -285,7 +532,6 @@ class Position(object):
         self.extra_infos = extra_infos
 
 
-
 class AltInfos(object):
     def __init__(self, pos, ref_base, depth, af_list, alt_dict, tumor_alt_dict, extra_infos=""):
         self.pos = pos
@@ -298,6 +544,35 @@ class AltInfos(object):
         self.max_candidate_af = None
         self.support_alternative_af = None
 
+@lru_cache(maxsize=8)
+def _contig_length_dict_from(fai_fn):
+    contig_length_dict = {}
+    with open(fai_fn, 'r') as fai_fp:
+        for row in fai_fp:
+            columns = row.rstrip().split('\t', 2)
+            contig_length_dict[columns[0]] = int(columns[1])
+    return contig_length_dict
+
+
+def contig_length_from(fai_fn, ctg_name):
+    """
+    Look up a contig length from the fasta index, the index is parsed once
+    per process instead of rescanned for every chunk.
+    """
+    return _contig_length_dict_from(fai_fn).get(ctg_name, 0)
+
+
+@lru_cache(maxsize=8)
+def _contig_header_block_from(fai_path, fai_mtime):
+    # fai_mtime only keys the cache so a rewritten index is re-read
+    rows = open(fai_path).read().splitlines()
+    parts = ["##contig=<ID=%s,length=%s>" % (columns[0], columns[1])
+             for columns in (row.split('\t', 2) for row in rows if row)]
+    if not parts:
+        return ""
+    return '\n'.join(parts) + '\n'
+
+
 def output_header(reference_file_path, output_fn=None, sample_name='SAMPLE'):
 
     header = dedent("""\
@@ -321,11 +596,8 @@ def output_header(reference_file_path, output_fn=None, sample_name='SAMPLE'):
 
     if reference_file_path is not None:
         reference_index_file_path = file_path_from(reference_file_path, suffix=".fai", exit_on_not_found=True, sep='.')
-        with open(reference_index_file_path, "r") as fai_fp:
-            for row in fai_fp:
-                columns = row.strip().split("\t")
-                contig_name, contig_size = columns[0], columns[1]
-                header += "##contig=<ID=%s,length=%s>" % (contig_name, contig_size) + '\n'
+        header += _contig_header_block_from(reference_index_file_path,
+                                            os.path.getmtime(reference_index_file_path))
 
     header += '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t%s' % (sample_name) + '\n'
 
@@ -0,0 +1,222 @@
+# BSD 3-Clause License
+#
+# Copyright 2023 The University of Hong Kong, Department of Computer Science
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# numpy is only available in the CPython environment; the pure-Python
+# fallbacks below keep this module importable under pypy3
+try:
+    import numpy as np
+except ModuleNotFoundError:
+    np = None
+
+try:
+    from numba import njit
+except ModuleNotFoundError:
+    njit = None
+
+_parse_pileup_kernel = None
+if njit is not None:
+    @njit(cache=True, nogil=True)
+    def _parse_pileup_kernel(buf):
+        """
+        Walk the mpileup base column as raw bytes with an integer cursor.
+        For each covering read emit the offset of its base character in buf,
+        plus the indel sign byte ('+'/'-', 0 when absent) and the offset/length
+        of the inserted or deleted sequence that follows the length digits.
+        """
+        n = buf.shape[0]
+        base_pos = np.empty(n, dtype=np.int32)
+        indel_sign = np.zeros(n, dtype=np.uint8)
+        indel_start = np.zeros(n, dtype=np.int32)
+        indel_len = np.zeros(n, dtype=np.int32)
+        m = 0
+        i = 0
+        while i < n:
+            c = buf[i]
+            if c == 43 or c == 45:  # '+' or '-', indel attached to the last base
+                i += 1
+                advance = 0
+                while i < n and 48 <= buf[i] <= 57:
+                    advance = advance * 10 + (buf[i] - 48)
+                    i += 1
+                if m > 0:
+                    indel_sign[m - 1] = c
+                    indel_start[m - 1] = i
+                    indel_len[m - 1] = advance
+                i += advance
+                continue
+            if c == 94:  # '^', the next byte is mapping quality
+                i += 2
+                continue
+            if c == 35 or c == 42:  # '#' or '*'
+                base_pos[m] = i
+                m += 1
+            else:
+                u = c & 0xDF  # uppercase fold for base letters
+                if u == 65 or u == 67 or u == 71 or u == 84 or u == 78:  # ACGTN
+                    base_pos[m] = i
+                    m += 1
+            # skip '$' and any other byte
+            i += 1
+        return m, base_pos, indel_sign, indel_start, indel_len
+
+
+_format_tensor_kernel = None
+if njit is not None:
+    @njit(cache=True, nogil=True)
+    def _format_tensor_kernel(flat, out):
+        """
+        Write the flattened channel values as space-separated ASCII decimals
+        into out, values are bounded by the int8 channel range. Returns the
+        number of bytes written.
+        """
+        cursor = 0
+        for i in range(flat.shape[0]):
+            if i > 0:
+                out[cursor] = 32  # ' '
+                cursor += 1
+            v = flat[i]
+            if v < 0:
+                out[cursor] = 45  # '-'
+                cursor += 1
+                v = -v
+            if v >= 100:
+                out[cursor] = 48 + v // 100
+                out[cursor + 1] = 48 + (v // 10) % 10
+                out[cursor + 2] = 48 + v % 10
+                cursor += 3
+            elif v >= 10:
+                out[cursor] = 48 + v // 10
+                out[cursor + 1] = 48 + v % 10
+                cursor += 2
+            else:
+                out[cursor] = 48 + v
+                cursor += 1
+        return cursor
+
+
+def format_tensor_string(tensor):
+    """
+    Serialize an integer tensor (ndarray or sequence of 2D rows) into the
+    space-separated ASCII form previously produced by the nested str joins,
+    without allocating one Python string per value.
+    """
+    if _format_tensor_kernel is not None:
+        flat = np.ascontiguousarray(tensor, dtype=np.int32).ravel()
+        out = np.empty(flat.shape[0] * 5, dtype=np.uint8)  # sign + 3 digits + separator
+        cursor = _format_tensor_kernel(flat, out)
+        return out[:cursor].tobytes().decode('ascii')
+    return " ".join(" ".join(" ".join(str(x) for x in innerlist) for innerlist in outerlist)
+                    for outerlist in tensor)
+
+
+# byte -> allele category: 0..3 for A/C/G/T either case, 4 for '#'/'*', -1 otherwise
+_BASE_CATEGORY_LUT = None
+if np is not None:
+    _BASE_CATEGORY_LUT = np.full(256, -1, dtype=np.int8)
+    for _category, _bases in enumerate(('Aa', 'Cc', 'Gg', 'Tt', '#*')):
+        for _b in _bases:
+            _BASE_CATEGORY_LUT[ord(_b)] = _category
+
+
+def decode_base_list_with_counts(pileup_bases):
+    """
+    Decode the base column like decode_base_list and additionally derive the
+    [A, C, G, T, ins, del] counts and covered depth from the kernel output with
+    one LUT gather and bincount, so callers skip a second Python loop over the
+    decoded reads. Returns (base_list, None, None) when numba is unavailable
+    and the caller keeps its scalar counting path.
+    """
+    if _parse_pileup_kernel is None:
+        return decode_base_list(pileup_bases), None, None
+    buf = np.frombuffer(pileup_bases.encode('ascii'), dtype=np.uint8)
+    m, base_pos, indel_sign, indel_start, indel_len = _parse_pileup_kernel(buf)
+    base_list = []
+    for idx in range(m):
+        sign = indel_sign[idx]
+        if sign:
+            seq_start = indel_start[idx]
+            indel = chr(sign) + pileup_bases[seq_start: seq_start + indel_len[idx]]
+        else:
+            indel = ""
+        base_list.append([pileup_bases[base_pos[idx]], indel])
+    categories = _BASE_CATEGORY_LUT[buf[base_pos[:m]]]
+    covered = categories >= 0
+    category_counts = np.bincount(categories[covered], minlength=5)
+    signs = indel_sign[:m]
+    counts = [int(category_counts[0]), int(category_counts[1]), int(category_counts[2]),
+              int(category_counts[3]), int((signs == 43).sum()), int((signs == 45).sum())]
+    return base_list, counts, int(covered.sum())
+
+
+def decode_base_list(pileup_bases):
+    """
+    Decode the mpileup base column into a list of [base, indel] per covering read,
+    indel keeps the leading '+'/'-' sign with the inserted/deleted sequence.
+    Dispatch to the numba byte-buffer kernel when numba is available, otherwise
+    fall back to the per-character Python parser.
+    """
+    if _parse_pileup_kernel is not None:
+        buf = np.frombuffer(pileup_bases.encode('ascii'), dtype=np.uint8)
+        m, base_pos, indel_sign, indel_start, indel_len = _parse_pileup_kernel(buf)
+        base_list = []
+        for idx in range(m):
+            sign = indel_sign[idx]
+            if sign:
+                seq_start = indel_start[idx]
+                indel = chr(sign) + pileup_bases[seq_start: seq_start + indel_len[idx]]
+            else:
+                indel = ""
+            base_list.append([pileup_bases[base_pos[idx]], indel])
+        return base_list
+
+    base_idx = 0
+    base_list = []
+    while base_idx < len(pileup_bases):
+        base = pileup_bases[base_idx]
+        if base == '+' or base == '-':
+            base_idx += 1
+            advance = 0
+            while True:
+                num = pileup_bases[base_idx]
+                if num.isdigit():
+                    advance = advance * 10 + int(num)
+                    base_idx += 1
+                else:
+                    break
+            base_list[-1][1] = base + pileup_bases[base_idx: base_idx + advance]  # add indel seq
+            base_idx += advance - 1
+
+        elif base in "ACGTNacgtn#*":
+            base_list.append([base, ""])
+        elif base == '^':  # start of read, next base is mq, update mq info
+            base_idx += 1
+        # skip $, the end of read
+        base_idx += 1
+    return base_list
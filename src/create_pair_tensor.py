@@ -29,31 +29,38 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import sys
+import os
 import shlex
+import shutil
 import json
 import logging
-import random
 import heapq
+import concurrent.futures
+from threading import Thread
+from queue import Queue
+from copy import deepcopy
+
+import numpy as np
 from subprocess import PIPE
-from itertools import product
 from argparse import ArgumentParser, SUPPRESS
-from collections import Counter, defaultdict, OrderedDict
+from collections import defaultdict, deque
 
 import shared.param as param
 from shared.utils import subprocess_popen, file_path_from, IUPAC_base_to_num_dict as BASE2NUM, region_from, \
-    reference_sequence_from, str2bool, vcf_candidates_from
-from shared.interval_tree import bed_tree_from, is_region_in
-
-from src.create_tensor import NORMAL_HAP_TYPE, TUMOR_HAP_TYPE, normalize_bq, normalize_mq, ACGT_NUM, \
-    STRAND_0, STRAND_1, get_chunk_id
+    reference_sequence_from, str2bool, vcf_candidates_from, contig_length_from, zstd_writer_from, \
+    batched_line_generator_from, widen_pipe_buffer
+from shared.interval_tree import bed_tree_from, is_region_in, region_mask_from
+
+from src.create_tensor import NORMAL_HAP_TYPE, TUMOR_HAP_TYPE, normalize_bq_array, normalize_mq_array, ACGT_NUM, \
+    ACGT_NUM_LUT, ACGT_INDEX, REVERSE_STRAND_BASES, STRAND_0, STRAND_1, WRITE_BUFFER_SIZE, get_chunk_id, \
+    batch_tensor_channels
+from src._pileup_numba import decode_base_list, decode_base_list_with_counts, format_tensor_string
 logging.basicConfig(format='%(message)s', level=logging.INFO)
 
 BASES = set(list(BASE2NUM.keys()) + ["-"])
 no_of_positions = param.no_of_positions
 flanking_base_num = param.flankingBaseNum
 channel_size = param.channel_size
-BASE2NUMBER = dict(zip("ACGTURYSWKMBDHVN-", (0, 1, 2, 3, 3, 0, 1, 1, 0, 2, 0, 1, 0, 0, 0, 0, 4)))
-HAP_TYPE = dict(zip((1, 0, 2), (30, 60, 90)))  # hap1 UNKNOWN H2
 
 
 
@@ -78,17 +85,37 @@ class Position(object):
         self.phase_set = phase_set
         self.genotype = genotype
         self.read_name_seq = defaultdict(str)
+        self._read_name_dict = None
+
+    @property
+    def read_name_dict(self):
+        # only find_tumor_alt_match reads this, and only at the center position,
+        # so skip building the dict for every windowed position
+        if self._read_name_dict is None:
+            self._read_name_dict = dict(zip(self.read_name_list, self.base_list))
+        return self._read_name_dict
 
     def update_infos(self, is_tumor=False, hap_dict=None, mask_low_bq=False, platform='ont'):
         # only proceed when variant exists in candidate windows which greatly improves efficiency
-        self.read_name_dict = dict(zip(self.read_name_list, self.base_list))
         self.update_info = True
-        self.mapping_quality = [normalize_mq(phredscore2raw_score(item)) for item in self.raw_mapping_quality]
-        self.base_quality = [normalize_bq(phredscore2raw_score(item), platform) for item in self.raw_base_quality]
-
-        for read_name, base_info, bq, mq in zip(self.read_name_list, self.base_list, self.base_quality,
-                                                self.mapping_quality):
-            hp = hap_dict[read_name] if hap_dict is not None and read_name in hap_dict else 0
+        # one C-level subtraction per quality string instead of per-character ord() calls
+        self.mapping_quality = normalize_mq_array(
+            np.frombuffer(self.raw_mapping_quality.encode('ascii'), dtype=np.uint8).astype(np.int32) - 33)
+        self.base_quality = normalize_bq_array(
+            np.frombuffer(self.raw_base_quality.encode('ascii'), dtype=np.uint8).astype(np.int32) - 33, platform)
+
+        hap_list = [hap_dict[read_name] if hap_dict is not None and read_name in hap_dict else 0
+                    for read_name in self.read_name_list]
+        channel_matrix = batch_tensor_channels(self.base_list, self.base_quality, self.mapping_quality,
+                                               self.ref_base, mask_low_bq, is_tumor, hap_list=hap_list)
+        if channel_matrix is not None:
+            for row_idx, (read_name, (base, indel)) in enumerate(zip(self.read_name_list, self.base_list)):
+                ins_base = indel[1:].upper() if base not in '*#' and indel != '' and indel[0] == '+' else ""
+                self.read_info[read_name] = (channel_matrix[row_idx], ins_base)
+            return
+
+        for read_name, base_info, bq, mq, hp in zip(self.read_name_list, self.base_list, self.base_quality,
+                                                    self.mapping_quality, hap_list):
             read_channel, ins_base, query_base = get_tensor_info(base_info, bq, self.ref_base, mask_low_bq, mq,
                                                                  is_tumor, hp=hp)
             self.read_info[read_name] = (read_channel, ins_base)
@@ -121,25 +148,33 @@ def sorted_by_hap_read_name(center_pos, haplotag_dict, pileup_dict, hap_dict, ma
     while haplotype information directly acquire from BAM HP tag.
     platform: select maximum depth for each platform.
     """
-    all_nearby_read_name = []
     start_pos, end_pos = center_pos - flanking_base_num, center_pos + flanking_base_num + 1
+    # dict.fromkeys dedupes in first-seen order at C speed, no per-name set probe
+    nearby_read_name_dict = {}
     for p in range(start_pos, end_pos):
-        if p in pileup_dict.keys():
-            all_nearby_read_name += pileup_dict[p].read_name_list
-    all_nearby_read_name = list(OrderedDict.fromkeys(all_nearby_read_name))  # have sorted by order
+        position = pileup_dict.get(p)
+        if position is None:
+            continue
+        nearby_read_name_dict.update(dict.fromkeys(position.read_name_list))
+    all_nearby_read_name = list(nearby_read_name_dict)
     matrix_depth = max_depth
     if len(all_nearby_read_name) > matrix_depth and not use_tensor_sample_mode:
-        # set same seed for reproducibility
-        random.seed(0)
-        indices = random.sample(range(len(all_nearby_read_name)), matrix_depth)
-        all_nearby_read_name = [all_nearby_read_name[i] for i in sorted(indices)]
-    sorted_read_name_list = []
-    for order, read_name in enumerate(all_nearby_read_name):
-        hap = max(haplotag_dict[read_name], hap_dict[read_name])  # no phasing is 0
-        sorted_read_name_list.append((hap, order, read_name))
-
-    sorted_read_name_list = sorted(sorted_read_name_list, key=lambda x: (x[0], x[1]))
-    return sorted_read_name_list
+        # fixed seed for reproducibility, C-level sampling without replacement
+        rng = np.random.default_rng(0)
+        indices = np.sort(rng.choice(len(all_nearby_read_name), matrix_depth, replace=False))
+        all_nearby_read_name = [all_nearby_read_name[i] for i in indices]
+    haplotag_get, hap_get = haplotag_dict.get, hap_dict.get
+    # SoA layout: parallel hap/order arrays plus the read name list, no per-read tuples
+    read_haps = np.fromiter((max(haplotag_get(read_name, 0), hap_get(read_name, 0))  # no phasing is 0
+                             for read_name in all_nearby_read_name),
+                            dtype=np.int8, count=len(all_nearby_read_name))
+    read_orders = np.arange(len(all_nearby_read_name), dtype=np.int32)
+    # vectorized (hap, order) sort, orders are unique so the combined key is too
+    perm = np.argsort((read_haps.astype(np.int64) << 32) | read_orders)
+    read_haps = read_haps[perm]
+    read_orders = read_orders[perm]
+    read_name_list = [all_nearby_read_name[i] for i in perm]
+    return read_haps, read_orders, read_name_list
 
 
 def get_tensor_info(base_info, bq, ref_base, mask_low_bq=False, read_mq=None, is_tumor=False, hp=0):
@@ -158,7 +193,7 @@ def get_tensor_info(base_info, bq, ref_base, mask_low_bq=False, read_mq=None, is
     query_base = ""
     read_channel = [0] * channel_size
     if base[0] in '*#':
-        read_channel[1] = ACGT_NUM[base[0]]
+        read_channel[1] = ACGT_NUM_LUT[ord(base[0])]
         return read_channel, ins_base, query_base
     strand = STRAND_1
     if base[0] in 'ACGT':
@@ -167,15 +202,15 @@ def get_tensor_info(base_info, bq, ref_base, mask_low_bq=False, read_mq=None, is
 
     base_upper = base.upper()
     if indel != '':
-        ALT_BASE = ACGT_NUM[indel[0]]
+        ALT_BASE = ACGT_NUM_LUT[ord(indel[0])]
     elif (base_upper != ref_base and base_upper in 'ACGT'):
         base_upper = evc_base_from(base_upper)
-        ALT_BASE = ACGT_NUM[base_upper]
+        ALT_BASE = ACGT_NUM_LUT[ord(base_upper)]
         if mask_low_bq and bq < 33 and ALT_BASE:  # bq < 20
             ALT_BASE = 0
             bq = 0
 
-    REF_BASE = ACGT_NUM[ref_base]
+    REF_BASE = ACGT_NUM_LUT[ord(ref_base)]
     if len(indel) and indel[0] in '+-':
         if indel[0] == "+":
             ins_base = indel[1:].upper()
@@ -204,69 +239,49 @@ def decode_pileup_bases(pos,
     has_pileup_candidates: if the candidate is directly obtained from pileup output, then no need to check the af filtering.
     """
 
-    base_idx = 0
-    base_list = []
-    while base_idx < len(pileup_bases):
-        base = pileup_bases[base_idx]
-        if base == '+' or base == '-':
-            base_idx += 1
-            advance = 0
-            while True:
-                num = pileup_bases[base_idx]
-                if num.isdigit():
-                    advance = advance * 10 + int(num)
-                    base_idx += 1
-                else:
-                    break
-            base_list[-1][1] = base + pileup_bases[base_idx: base_idx + advance]  # add indel seq
-            base_idx += advance - 1
-
-        elif base in "ACGTNacgtn#*":
-            base_list.append([base, ""])
-        elif base == '^':  # start of read, next base is mq, update mq info
-            base_idx += 1
-        # skip $, the end of read
-        base_idx += 1
-    if has_pileup_candidates:
-        if pos not in candidates_type_dict or not is_tumor:
-            return base_list, None, True, 1.0
-    pileup_dict = defaultdict(int)
-    base_counter = Counter([''.join(item) for item in base_list])
-    depth = 0
-    for key, count in base_counter.items():
-        if key[0].upper() in 'ACGT':
-            pileup_dict[key[0].upper()] += count
-            depth += count
-        elif key[0] in "#*":
-            depth += count
-        if len(key) > 1 and key[1] == '+':
-            pileup_dict['I'] += count
-        elif len(key) > 1 and key[1] == '-':
-            pileup_dict['D'] += count
+    if has_pileup_candidates and (pos not in candidates_type_dict or not is_tumor):
+        return decode_base_list(pileup_bases), None, True, 1.0
+
+    base_list, counts, depth = decode_base_list_with_counts(pileup_bases)
+    if counts is None:
+        # scalar fallback, single pass over base_list
+        counts = [0, 0, 0, 0, 0, 0]  # A C G T I D
+        depth = 0
+        for base, indel in base_list:
+            base_index = ACGT_INDEX.get(base, -1)
+            if base_index >= 0:
+                counts[base_index] += 1
+                depth += 1
+            elif base in "#*":
+                depth += 1
+            if indel != '':
+                counts[4 if indel[0] == '+' else 5] += 1
 
     minimum_snv_af_for_candidate = minimum_snv_af_for_candidate if minimum_snv_af_for_candidate > 0 else param.min_af
     minimum_indel_af_for_candidate = minimum_indel_af_for_candidate if minimum_indel_af_for_candidate > 0 else \
     param.min_af_dict[platform]
 
     denominator = depth if depth > 0 else 1
-    pileup_list = sorted(list(pileup_dict.items()), key=lambda x: x[1], reverse=True)
-
-    pass_snv_af = False
-    pass_indel_af = False
-
-    for item, count in pileup_list:
-        if pass_snv_af or pass_indel_af:
-            break
-        if item == reference_base:
-            continue
-        elif item[0] in 'ID':
-            pass_indel_af = (pass_indel_af or (float(count) / denominator >= minimum_indel_af_for_candidate))
-            continue
-        pass_snv_af = pass_snv_af or (float(count) / denominator >= minimum_snv_af_for_candidate)
-
-    af = (float(pileup_list[1][1]) / denominator) if len(pileup_list) > 1 else 0.0
-    af = (float(pileup_list[0][1]) / denominator) if len(pileup_list) >= 1 and pileup_list[0][
-        0] != reference_base else af
+    # vectorized AF checks over the six counts, no sorted allele list needed
+    counts_arr = np.asarray(counts, dtype=np.int32)
+    af_array = counts_arr / denominator
+    ref_index = ACGT_INDEX.get(reference_base, -1)
+    nonref_mask = np.ones(4, dtype=bool)
+    if ref_index >= 0:
+        nonref_mask[ref_index] = False
+    pass_snv_af = bool((af_array[:4][nonref_mask] >= minimum_snv_af_for_candidate).any())
+    pass_indel_af = bool((af_array[4:] >= minimum_indel_af_for_candidate).any())
+
+    # af follows the old sorted-list rule: top non-reference count, otherwise runner-up
+    top_index = int(np.argmax(counts_arr))
+    top_count = int(counts_arr[top_index])
+    if top_count == 0:
+        af = 0.0
+    elif top_index != ref_index:
+        af = float(top_count) / denominator
+    else:
+        counts_arr[top_index] = 0
+        af = float(counts_arr.max()) / denominator
 
     pass_af = pass_snv_af or pass_indel_af
 
@@ -286,16 +301,18 @@ def get_alt_info(center_pos, pileup_dict, ref_seq, reference_sequence, reference
     """
 
     reference_base = ref_seq[flanking_base_num]
-    alt_read_name_dict = defaultdict(set)
+    # a read lands in at most one key per branch, so plain appends keep entries unique
+    alt_read_name_dict = defaultdict(list)
     depth = 0
-    for (base, indel), read_name in zip(pileup_dict[center_pos].base_list, pileup_dict[center_pos].read_name_list):
+    center_position = pileup_dict[center_pos]
+    for (base, indel), read_name in zip(center_position.base_list, center_position.read_name_list):
         if base in "#*":
-            alt_read_name_dict['*'].add(read_name)
+            alt_read_name_dict['*'].append(read_name)
             depth += 1
             continue
         depth += 1
         if base.upper() == reference_base and indel == '':
-            alt_read_name_dict['R'].add(read_name)
+            alt_read_name_dict['R'].append(read_name)
         if indel != '':
             if indel[0] == '+':
                 indel = 'I' + base.upper() + indel.upper()[1:]
@@ -304,23 +321,23 @@ def get_alt_info(center_pos, pileup_dict, ref_seq, reference_sequence, reference
                 del_ref_bases = reference_sequence[
                                 center_pos - reference_start + 1:center_pos - reference_start + del_bases_num + 1]
                 indel = 'D' + del_ref_bases
-            alt_read_name_dict[indel].add(read_name)
+            alt_read_name_dict[indel].append(read_name)
 
         if indel == '' and base.upper() != reference_base:
-            alt_read_name_dict['X' + base.upper()].add(read_name)
+            alt_read_name_dict['X' + base.upper()].append(read_name)
 
-    for alt_type, read_name_set in list(alt_read_name_dict.items()):
+    for alt_type, read_name_list in list(alt_read_name_dict.items()):
         alt_read_name_dict[alt_type] = ' '.join(
-            [read_name + '_' + str(hap_dict[read_name]) for read_name in list(read_name_set)])
+            read_name + '_' + str(hap_dict.get(read_name, 0)) for read_name in read_name_list)
 
     alt_info = str(depth) + '\t' + json.dumps(alt_read_name_dict)
 
     return alt_info
 
 
-def find_tumor_alt_match(center_pos, sorted_read_name_list, pileup_dict, truths_variant_dict):
-    tumor_reads = [read_name for (hap, _, read_name) in sorted_read_name_list if read_name.startswith('t')]
-    normal_reads = [read_name for (hap, _, read_name) in sorted_read_name_list if read_name.startswith('n')]
+def find_tumor_alt_match(center_pos, read_name_list, pileup_dict, truths_variant_dict):
+    tumor_reads = [read_name for read_name in read_name_list if read_name.startswith('t')]
+    normal_reads = [read_name for read_name in read_name_list if read_name.startswith('n')]
     ref_base, alt_base = truths_variant_dict[center_pos].reference_bases, \
                          truths_variant_dict[center_pos].alternate_bases[0]
     is_ins = len(alt_base) > 1 and len(ref_base) == 1
@@ -329,9 +346,11 @@ def find_tumor_alt_match(center_pos, sorted_read_name_list, pileup_dict, truths_
 
     matched_read_name_set = set()
     normal_read_name_set = set(normal_reads)
+    center_read_name_dict = pileup_dict[center_pos].read_name_dict
     for read_name in tumor_reads:
-        if read_name in pileup_dict[center_pos].read_name_dict:
-            base, indel = pileup_dict[center_pos].read_name_dict[read_name]
+        base_info = center_read_name_dict.get(read_name)
+        if base_info is not None:
+            base, indel = base_info
             base_upper = base.upper()
             if is_ins and indel[1:].upper() == alt_base:
                 matched_read_name_set.add(read_name)
@@ -345,7 +364,7 @@ def find_tumor_alt_match(center_pos, sorted_read_name_list, pileup_dict, truths_
 def generate_tensor(args,
                     ctg_name,
                     center_pos,
-                    sorted_read_name_list,
+                    sorted_read_name_infos,
                     pileup_dict,
                     ref_seq,
                     reference_sequence,
@@ -356,13 +375,14 @@ def generate_tensor(args,
                     candidates_type_dict,
                     use_tensor_sample_mode=False,
                     truths_variant_dict=None,
-                    hap_dict=None):
+                    hap_dict=None,
+                    center_position=None):
     """
     Generate full alignment input tensor
     ctg_name: provided contig name.
     center_pos: center position for full alignment generation, default window size = no_of_positions =
     flankingBaseNum + 1 + flankingBaseNum
-    sorted_read_name_list: read name list which have been sorted by read start position and haplotype.
+    sorted_read_name_infos: parallel hap/order arrays and read name list, sorted by read start position and haplotype.
     pileup_dict: dictionary (pos: pos info) which keep read information that cover specific position .
     ref_seq: chunked reference sequence in window, start: center pos - flankingBaseNum, end: center + flankingBaseNum + 1.
     reference_sequence: reference sequence index by contig:start-end. 0-based.
@@ -376,10 +396,12 @@ def generate_tensor(args,
 
     tensor_shape = param.ont_input_shape if platform == 'ont' else param.input_shape
     reference_base = ref_seq[flanking_base_num]
-    tensor_depth = len(sorted_read_name_list)
+    read_haps, read_orders, read_name_list = sorted_read_name_infos
+    tensor_depth = len(read_name_list)
     if tensor_depth == 0:
         return None, None
-    tensor = [[[0] * tensor_shape[2] for _ in range(tensor_shape[1])] for _ in range(tensor_depth)]
+    # all stored channel values are within int8 range, ~8x smaller than nested lists
+    tensor = np.zeros((tensor_depth, tensor_shape[1], tensor_shape[2]), dtype=np.int8)
     start_pos, end_pos = center_pos - flanking_base_num, center_pos + flanking_base_num + 1
     insert_tuple = []
 
@@ -390,27 +412,35 @@ def generate_tensor(args,
     if not pass_confident_bed:
         return None, None
 
+    # iterate each position's covering reads instead of all depth x window cells
+    read_index_of = {read_name: read_idx for read_idx, read_name in enumerate(read_name_list)}
     for p in range(start_pos, end_pos):
-        if p in pileup_dict and not pileup_dict[p].update_info:
-            pileup_dict[p].update_infos(is_tumor=is_tumor, hap_dict=hap_dict, mask_low_bq=args.mask_low_bq,
-                                        platform=platform)
-        for read_idx, read_name_info in enumerate(sorted_read_name_list):
-            hap, read_order, read_name = read_name_info
-            offset = p - start_pos
-            if p in pileup_dict and read_name in pileup_dict[p].read_info:
-                read_channel, ins_base = pileup_dict[p].read_info[read_name]
-                tensor[read_idx][offset] = read_channel
-                if ins_base != '' and p < end_pos - 1:
-                    insert_tuple.append((read_idx, offset, ins_base, p))
+        position = pileup_dict.get(p)
+        if position is None:
+            continue
+        if not position.update_info:
+            position.update_infos(is_tumor=is_tumor, hap_dict=hap_dict, mask_low_bq=args.mask_low_bq,
+                                  platform=platform)
+        offset = p - start_pos
+        collect_ins = p < end_pos - 1
+        for read_name, (read_channel, ins_base) in position.read_info.items():
+            read_idx = read_index_of.get(read_name)
+            if read_idx is None:
+                continue
+            tensor[read_idx, offset] = read_channel
+            if ins_base != '' and collect_ins:
+                insert_tuple.append((read_idx, offset, ins_base, p))
 
     for read_idx, p, ins_base, center_p in insert_tuple:
+        ins_length = min(len(ins_base), no_of_positions - p)
+        ins_codes = np.frombuffer(ins_base[:ins_length].encode('ascii'), dtype=np.uint8)
+        tensor[read_idx, p: p + ins_length, 6] = ACGT_NUM_LUT[ins_codes]
 
-        for ins_idx in range(min(len(ins_base), no_of_positions - p)):
-            tensor[read_idx][ins_idx + p][6] = ACGT_NUM[ins_base[ins_idx]]
-
+    if center_position is None:
+        center_position = pileup_dict[center_pos]
     alt_dict = defaultdict(int)
     depth, max_del_length = 0, 0
-    for base, indel in pileup_dict[center_pos].base_list:
+    for base, indel in center_position.base_list:
         if base in "#*":
             depth += 1
             continue
@@ -440,8 +470,7 @@ def generate_tensor(args,
         else:
             alt_info.append(['X' + alt_type, str(alt_count)])
     alt_info = str(depth) + '-' + ' '.join([' '.join([item[0], str(item[1])]) for item in alt_info]) + '-' + af_infos
-    tensor_string_list = [
-        " ".join((" ".join(" ".join(str(x) for x in innerlist) for innerlist in outerlist)) for outerlist in tensor)]
+    tensor_string_list = [format_tensor_string(tensor)]
 
     return tensor_string_list, [alt_info]
 
@@ -450,7 +479,9 @@ class TensorStdout(object):
     def __init__(self, handle):
         self.stdin = handle
 
-    def __del__(self):
+    def close(self):
+        # explicit close instead of a __del__ finalizer, flushing is deterministic
+        # and no reference cycle keeps the handle alive until interpreter shutdown
         self.stdin.close()
 
 
@@ -475,32 +506,56 @@ def get_normal_set(alt_fn):
     return normal_pos_set
 
 
+_PREFETCH_DONE = object()
+
+
+def pileup_prefetch_generator_from(generator, maxsize=64):
+    """
+    Drain a pileup generator in a background thread through a bounded queue so
+    the normal and tumor mpileup streams are decoded concurrently, the numba
+    kernels run with nogil so both threads make progress at once. The producers
+    only insert into their pileup dicts, position eviction is owned by the
+    consumer loop in create_pair_tensor.
+    """
+    prefetch_queue = Queue(maxsize=maxsize)
+
+    def produce():
+        try:
+            for item in generator:
+                prefetch_queue.put(item)
+            prefetch_queue.put(_PREFETCH_DONE)
+        except Exception as e:
+            prefetch_queue.put(e)
+
+    Thread(target=produce, daemon=True).start()
+
+    while True:
+        item = prefetch_queue.get()
+        if item is _PREFETCH_DONE:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
 def heapq_merge_generator_from(normal_bam_pileup_generator, tumor_bam_pileup_generator, skip_if_normal_empty=True):
     normal_candidates_set = set()
-    tumor_candidates_set = set()
     for pos, is_tumor in heapq.merge(normal_bam_pileup_generator, tumor_bam_pileup_generator):
         if is_tumor:
             if pos in normal_candidates_set or not skip_if_normal_empty:
                 yield pos
                 normal_candidates_set.discard(pos)
-            else:
-                continue
         else:
             normal_candidates_set.add(pos)
 
-    for pos in tumor_candidates_set:
-        if pos in normal_candidates_set:
-            yield pos
-
 
 def get_key_list(input_dict, normal_tensor_infos_dict, tumor_tensor_infos_dict, shuffle=True):
-    normal_index_list = range(len(input_dict['normal'][0]))
-    tumor_index_list = range(len(input_dict['tumor'][0]))
-    for normal_idx, tumor_idx in product(normal_index_list, tumor_index_list):
-        normal_tensor, normal_alt_info = normal_tensor_infos_dict[0][normal_idx], normal_tensor_infos_dict[1][
-            normal_idx]
-        tumor_tensor, tumor_alt_info = tumor_tensor_infos_dict[0][normal_idx], tumor_tensor_infos_dict[1][normal_idx]
-        yield (normal_tensor, normal_alt_info, tumor_tensor, tumor_alt_info)
+    normal_tensor_list, normal_alt_info_list = normal_tensor_infos_dict[0], normal_tensor_infos_dict[1]
+    tumor_tensor_list, tumor_alt_info_list = tumor_tensor_infos_dict[0], tumor_tensor_infos_dict[1]
+    for normal_idx in range(len(input_dict['normal'][0])):
+        normal_tensor, normal_alt_info = normal_tensor_list[normal_idx], normal_alt_info_list[normal_idx]
+        for tumor_idx in range(len(input_dict['tumor'][0])):
+            yield (normal_tensor, normal_alt_info, tumor_tensor_list[tumor_idx], tumor_alt_info_list[tumor_idx])
 
 
 def create_pair_tensor(args):
@@ -531,7 +586,7 @@ def create_pair_tensor(args):
     is_known_vcf_file_provided = vcf_fn is not None
     tensor_sample_mode = args.tensor_sample_mode
     candidates_pos_set = set()
-    candidates_type_dict = defaultdict(str)
+    candidates_type_dict = {}
     add_read_regions = True
 
     truth_vcf_fn = args.truth_vcf_fn
@@ -576,15 +631,7 @@ def create_pair_tensor(args):
         Whole genome calling option, acquire contig start end position from reference fasta index(.fai), then split the
         reference accroding to chunk id and total chunk numbers.
         """
-        contig_length = 0
-        with open(fai_fn, 'r') as fai_fp:
-            for row in fai_fp:
-                columns = row.strip().split("\t")
-
-                contig_name = columns[0]
-                if contig_name != ctg_name:
-                    continue
-                contig_length = int(columns[1])
+        contig_length = contig_length_from(fai_fn, ctg_name)
         chunk_size = contig_length // chunk_num + 1 if contig_length % chunk_num else contig_length // chunk_num
         ctg_start = chunk_size * chunk_id  # 0-base to 1-base
         ctg_end = ctg_start + chunk_size
@@ -617,6 +664,8 @@ def create_pair_tensor(args):
     )
     if reference_sequence is None or len(reference_sequence) == 0:
         sys.exit("[ERROR] Failed to load reference sequence from file ({}).".format(fasta_file_path))
+    # uppercase once at load so per-candidate slices skip their own copies
+    reference_sequence = reference_sequence.upper()
 
     nomral_phasing_option = " --output-extra HP" if phase_normal else " "
     tumor_phasing_option = " --output-extra HP" if phase_tumor else " "
@@ -636,22 +685,30 @@ def create_pair_tensor(args):
     samtools_command = "{} mpileup --reverse-del".format(samtools_execute_command) + \
                        output_read_name_option + output_mq_option + reads_regions_option + mq_option + bq_option + bed_option + flags_option + max_depth_option
     samtools_mpileup_normal_process = subprocess_popen(
-        shlex.split(samtools_command + ' ' + nomral_phasing_option + ' ' + normal_bam_file_path), stderr=PIPE)
+        shlex.split(samtools_command + ' ' + nomral_phasing_option + ' ' + normal_bam_file_path), stderr=PIPE,
+        text=False)
 
     samtools_mpileup_tumor_process = subprocess_popen(
-        shlex.split(samtools_command + ' ' + tumor_phasing_option + ' ' + tumor_bam_file_path), stderr=PIPE)
+        shlex.split(samtools_command + ' ' + tumor_phasing_option + ' ' + tumor_bam_file_path), stderr=PIPE,
+        text=False)
+    widen_pipe_buffer(samtools_mpileup_normal_process.stdout)
+    widen_pipe_buffer(samtools_mpileup_tumor_process.stdout)
 
     if tensor_can_output_path != "PIPE":
-        tensor_can_fpo = open(tensor_can_output_path, "wb")
-        tensor_can_fp = subprocess_popen(shlex.split("{} -c".format(args.zstd)), stdin=PIPE, stdout=tensor_can_fpo)
+        tensor_can_fp, tensor_can_fpo = zstd_writer_from(tensor_can_output_path, args.zstd)
     else:
         tensor_can_fp = TensorStdout(sys.stdout)
 
-    normal_hap_dict = defaultdict(int)
-    tumor_hap_dict = defaultdict(int)
-    haplotag_dict = defaultdict(int)
-    normal_pileup_dict = defaultdict(str)
-    tumor_pileup_dict = defaultdict(str)
+    # plain dicts: every entry is assigned explicitly, no __missing__ inserts
+    normal_hap_dict = {}
+    tumor_hap_dict = {}
+    haplotag_dict = {}
+    normal_pileup_dict = {}
+    tumor_pileup_dict = {}
+    # insertion (= position) order per stream, for O(1) window eviction; the
+    # producer threads only append on the right, the consumer only pops left
+    normal_pos_deque = deque()
+    tumor_pos_deque = deque()
 
     extend_bp_distance = no_of_positions + param.extend_bp
     confident_bed_tree = bed_tree_from(bed_file_path=confident_bed_fn,
@@ -663,21 +720,29 @@ def create_pair_tensor(args):
                                     contig_name=ctg_name,
                                     bed_ctg_start=extend_start,
                                     bed_ctg_end=extend_end)
+    # flatten the extend bed into a boolean per-position mask when the row
+    # positions are bounded, one indexed load per row instead of a tree query
+    extend_bed_mask = region_mask_from(extend_bed_tree, ctg_name, extend_start, extend_end) \
+        if is_extend_bed_file_given and extend_start is not None else None
 
     def samtools_pileup_generator_from(samtools_mpileup_process, is_tumor=True, phasing_info_in_bam=False):
         candidate_pos_list = sorted(list(candidates_pos_set))
         current_pos_index = 0
+        # the pending candidate is cached so the per-row guard is one compare
+        cp_target = candidate_pos_list[0] if candidate_pos_list else sys.maxsize
         has_pileup_candidates = len(candidates_pos_set)
         pileup_dict = tumor_pileup_dict if is_tumor else normal_pileup_dict
+        pos_deque = tumor_pos_deque if is_tumor else normal_pos_deque
         hap_dict = tumor_hap_dict if is_tumor else normal_hap_dict
 
-        for row in samtools_mpileup_process.stdout:  # chr position N depth seq BQ read_name mapping_quality phasing_info
-            columns = row.strip().split('\t')
+        # binary chunked reads, one ascii decode per line instead of a text-mode pipe
+        for row in batched_line_generator_from(samtools_mpileup_process.stdout):  # chr position N depth seq BQ read_name mapping_quality phasing_info
+            columns = row.split('\t')
             pos = int(columns[1])
             # pos that near bed region should include some indel cover in bed
-            pass_extend_bed = not is_extend_bed_file_given or is_region_in(extend_bed_tree,
-                                                                           ctg_name, pos - 1,
-                                                                           pos + 1)
+            pass_extend_bed = not is_extend_bed_file_given or \
+                (extend_bed_mask[pos - extend_start] if extend_bed_mask is not None
+                 else is_region_in(extend_bed_tree, ctg_name, pos - 1, pos + 1))
             pass_ctg_range = not ctg_start or (pos >= ctg_start and pos <= ctg_end)
             if not has_pileup_candidates and not pass_extend_bed and pass_ctg_range:
                 continue
@@ -685,7 +750,7 @@ def create_pair_tensor(args):
             raw_base_quality = columns[5]
             raw_mapping_quality = columns[6]
             read_name_list = columns[7].split(',')
-            reference_base = reference_sequence[pos - reference_start].upper()
+            reference_base = reference_sequence[pos - reference_start]
             if reference_base not in 'ACGT':
                 continue
             base_list, depth, pass_af, af = decode_pileup_bases(pos=pos,
@@ -697,12 +762,12 @@ def create_pair_tensor(args):
                                                                 candidates_type_dict=candidates_type_dict,
                                                                 is_tumor=is_tumor)
 
+            if len(read_name_list) != len(base_list):
+                continue
             if platform == 'ilmn':
-                for b_idx, base in enumerate(base_list):
-                    if base[0] == '#' or (base[0] >= 'a' and base[0] <= 'z'):
-                        read_name_list[b_idx] += '_1'  # reverse
-                    else:
-                        read_name_list[b_idx] += '_0'  # forward
+                # single zip pass, no per-base index assignment ('_1' reverse, '_0' forward)
+                read_name_list = [read_name + ('_1' if base in REVERSE_STRAND_BASES else '_0')
+                                  for read_name, (base, _) in zip(read_name_list, base_list)]
 
             if phasing_info_in_bam:
                 phasing_info = columns[8].split(',')
@@ -713,16 +778,18 @@ def create_pair_tensor(args):
                         if hap in '12' and read_name_list[hap_idx] not in hap_dict:
                             hap_dict[read_name_list[hap_idx]] = int(hap)
 
-            if len(read_name_list) != len(base_list):
-                continue
-
             if not is_known_vcf_file_provided and not has_pileup_candidates and reference_base in 'ACGT' and (
                     pass_af and depth >= min_coverage):
                 candidate_pos_list.append(pos)
+                if current_pos_index == len(candidate_pos_list) - 1:
+                    cp_target = pos
 
             if is_known_vcf_file_provided and not has_pileup_candidates and pos in known_variants_set:
                 candidate_pos_list.append(pos)
+                if current_pos_index == len(candidate_pos_list) - 1:
+                    cp_target = pos
 
+            pos_deque.append(pos)
             pileup_dict[pos] = Position(pos=pos,
                                         ref_base=reference_base,
                                         read_name_list=read_name_list,
@@ -732,54 +799,59 @@ def create_pair_tensor(args):
                                         af=af,
                                         depth=depth)
 
-            if current_pos_index < len(candidate_pos_list) and pos - candidate_pos_list[
-                current_pos_index] > extend_bp_distance:
-                yield (candidate_pos_list[current_pos_index], is_tumor)
-                for pre_pos in sorted(pileup_dict.keys()):
-                    if candidate_pos_list[current_pos_index] - pre_pos > extend_bp_distance:
-                        del pileup_dict[pre_pos]
-                    else:
-                        break
+            if pos - cp_target > extend_bp_distance:
+                yield (cp_target, is_tumor)
                 current_pos_index += 1
+                cp_target = candidate_pos_list[current_pos_index] \
+                    if current_pos_index < len(candidate_pos_list) else sys.maxsize
         while current_pos_index != len(candidate_pos_list):
             yield (candidate_pos_list[current_pos_index], is_tumor)
-            for pre_pos in sorted(pileup_dict.keys()):
-                if candidate_pos_list[current_pos_index] - pre_pos > extend_bp_distance:
-                    del pileup_dict[pre_pos]
-                else:
-                    break
             current_pos_index += 1
 
-    normal_bam_pileup_generator = samtools_pileup_generator_from(
-        samtools_mpileup_process=samtools_mpileup_normal_process, is_tumor=False, phasing_info_in_bam=phase_normal)
-    tumor_bam_pileup_generator = samtools_pileup_generator_from(samtools_mpileup_process=samtools_mpileup_tumor_process,
-                                                                phasing_info_in_bam=phase_tumor)
+    normal_bam_pileup_generator = pileup_prefetch_generator_from(samtools_pileup_generator_from(
+        samtools_mpileup_process=samtools_mpileup_normal_process, is_tumor=False, phasing_info_in_bam=phase_normal))
+    tumor_bam_pileup_generator = pileup_prefetch_generator_from(samtools_pileup_generator_from(
+        samtools_mpileup_process=samtools_mpileup_tumor_process, phasing_info_in_bam=phase_tumor))
 
     tensor_count = 0
+    tensor_buffer = []
+    tensor_buffer_len = 0
     for pos in heapq_merge_generator_from(normal_bam_pileup_generator=normal_bam_pileup_generator,
                                           tumor_bam_pileup_generator=tumor_bam_pileup_generator):
-        if pos not in normal_pileup_dict or pos not in tumor_pileup_dict:
+        # candidates arrive in position order, drop positions behind every
+        # remaining candidate window here, where the producer threads cannot race
+        for window_pileup_dict, window_pos_deque in ((normal_pileup_dict, normal_pos_deque),
+                                                     (tumor_pileup_dict, tumor_pos_deque)):
+            while window_pos_deque and pos - window_pos_deque[0] > extend_bp_distance:
+                del window_pileup_dict[window_pos_deque.popleft()]
+        # fetch both center positions once, the guard and the later center
+        # lookups inside generate_tensor shared the same probes
+        normal_center_position = normal_pileup_dict.get(pos)
+        tumor_center_position = tumor_pileup_dict.get(pos)
+        if normal_center_position is None or tumor_center_position is None:
             continue
         ref_seq = reference_sequence[
-                  pos - reference_start - flanking_base_num: pos - reference_start + flanking_base_num + 1].upper()
+                  pos - reference_start - flanking_base_num: pos - reference_start + flanking_base_num + 1]
 
-        variant_type = candidates_type_dict[pos] if pos in candidates_type_dict else 'unknown'
+        # one dict lookup per candidate, shared by both tumor and normal passes
+        candidate_type = candidates_type_dict.get(pos)
+        variant_type = candidate_type if candidate_type is not None else 'unknown'
+        use_tensor_sample_mode = tensor_sample_mode and candidate_type == 'homo_somatic' \
+            and pos in truths_variant_dict
 
         tensor_infos_dict = defaultdict()
         for pileup_dict, is_tumor, tumor_flag in zip((normal_pileup_dict, tumor_pileup_dict), (False, True),
                                                      ('normal', 'tumor')):
-            use_tensor_sample_mode = tensor_sample_mode and candidates_type_dict[
-                pos] == 'homo_somatic' and pos in truths_variant_dict
             max_depth = param.tumor_matrix_depth_dict[platform] if is_tumor else param.normal_matrix_depth_dict[
                 platform]
             hap_dict = tumor_hap_dict if is_tumor else normal_hap_dict
-            sorted_read_name_list = sorted_by_hap_read_name(pos, haplotag_dict, pileup_dict, hap_dict, max_depth,
-                                                            use_tensor_sample_mode)
+            sorted_read_name_infos = sorted_by_hap_read_name(pos, haplotag_dict, pileup_dict, hap_dict, max_depth,
+                                                             use_tensor_sample_mode)
 
             tensor_string_list, alt_info_list = generate_tensor(args=args,
                                                                 ctg_name=ctg_name,
                                                                 center_pos=pos,
-                                                                sorted_read_name_list=sorted_read_name_list,
+                                                                sorted_read_name_infos=sorted_read_name_infos,
                                                                 pileup_dict=pileup_dict,
                                                                 ref_seq=ref_seq,
                                                                 reference_sequence=reference_sequence,
@@ -790,27 +862,33 @@ def create_pair_tensor(args):
                                                                 candidates_type_dict=candidates_type_dict,
                                                                 use_tensor_sample_mode=use_tensor_sample_mode,
                                                                 truths_variant_dict=truths_variant_dict,
-                                                                hap_dict=hap_dict)
+                                                                hap_dict=hap_dict,
+                                                                center_position=tumor_center_position if is_tumor
+                                                                else normal_center_position)
             if tensor_string_list is None:
                 continue
 
             tensor_infos_dict[tumor_flag] = (tensor_string_list, alt_info_list)
 
+        pos_str = str(pos)
         for tensor_infos in get_key_list(tensor_infos_dict, tensor_infos_dict['normal'], tensor_infos_dict['tumor']):
             normal_tensor_string, normal_alt_info, tumor_tensor_string, tumor_alt_info = tensor_infos
 
-            tensor = "%s\t%d\t%s\t%s\t%s\t%s\t%s\t%s\n" % (
-                ctg_name,
-                pos,
-                ref_seq,
-                normal_tensor_string,
-                normal_alt_info,
-                tumor_tensor_string,
-                tumor_alt_info,
-                variant_type)
-            tensor_can_fp.stdin.write(tensor)
+            # join beats %-formatting here, and pos is stringified once per candidate
+            tensor = "\t".join((ctg_name, pos_str, ref_seq, normal_tensor_string, normal_alt_info,
+                                tumor_tensor_string, tumor_alt_info, variant_type)) + "\n"
+            # batch rows and flush in large blocks instead of one write call per tensor
+            tensor_buffer.append(tensor)
+            tensor_buffer_len += len(tensor)
+            if tensor_buffer_len >= WRITE_BUFFER_SIZE:
+                tensor_can_fp.stdin.write("".join(tensor_buffer))
+                tensor_buffer.clear()
+                tensor_buffer_len = 0
             tensor_count += 1
 
+    if tensor_buffer:
+        tensor_can_fp.stdin.write("".join(tensor_buffer))
+
     samtools_mpileup_normal_process.stdout.close()
     samtools_mpileup_normal_process.wait()
     samtools_mpileup_tumor_process.stdout.close()
@@ -819,11 +897,40 @@ def create_pair_tensor(args):
         tensor_can_fp.stdin.close()
         tensor_can_fp.wait()
         tensor_can_fpo.close()
+    else:
+        tensor_can_fp.close()
 
     chunk_info = get_chunk_id(candidates_bed_regions)
     print("[INFO] {} {} Tensors generated: {}".format(ctg_name, chunk_info, tensor_count))
 
 
+def create_pair_tensor_parallel(args):
+    """
+    Run a whole-contig job with one worker process per sub-range. Each worker
+    reuses the existing chunk_id/chunk_num splitting and writes its own zstd
+    output, so concatenating the parts in range order yields a valid
+    multi-frame zstd stream identical row-wise to a sequential run.
+    """
+    threads = max(1, args.threads)
+    sub_args_list = []
+    for worker_id in range(threads):
+        sub_args = deepcopy(args)
+        sub_args.chunk_num = threads
+        sub_args.chunk_id = worker_id + 1
+        sub_args.tensor_can_fn = "{}_{}_{}".format(args.tensor_can_fn, worker_id, threads)
+        sub_args_list.append(sub_args)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=threads) as exec:
+        for result in exec.map(create_pair_tensor, sub_args_list):
+            pass
+
+    with open(args.tensor_can_fn, 'wb') as output_file:
+        for sub_args in sub_args_list:
+            with open(sub_args.tensor_can_fn, 'rb') as part_file:
+                shutil.copyfileobj(part_file, output_file)
+            os.remove(sub_args.tensor_can_fn)
+
+
 def main():
     parser = ArgumentParser(description="Generate normal-tumor pair variant candidate tensors for calling")
 
@@ -904,6 +1011,10 @@ def main():
     parser.add_argument('--test_pos', type=str2bool, default=0,
                         help=SUPPRESS)
 
+    ## Max #processes to split a whole-contig run into when no chunk is assigned
+    parser.add_argument('--threads', type=int, default=1,
+                        help=SUPPRESS)
+
     ## The number of chucks to be divided into for parallel processing
     parser.add_argument('--chunk_num', type=int, default=None,
                         help=SUPPRESS)
@@ -929,7 +1040,12 @@ def main():
 
     args = parser.parse_args()
 
-    create_pair_tensor(args)
+    is_whole_contig_run = args.ctg_name is not None and args.candidates_bed_regions is None \
+        and args.chunk_id is None and args.ctg_start is None and args.ctg_end is None
+    if is_whole_contig_run and args.threads > 1 and args.tensor_can_fn != "PIPE":
+        create_pair_tensor_parallel(args)
+    else:
+        create_pair_tensor(args)
 
 
 if __name__ == "__main__":
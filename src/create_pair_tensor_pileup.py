@@ -39,7 +39,7 @@ from collections import Counter, defaultdict
 
 import shared.param as param
 from shared.utils import subprocess_popen, file_path_from, IUPAC_base_to_num_dict as BASE2NUM, region_from, \
-    reference_sequence_from, str2bool, vcf_candidates_from
+    reference_sequence_from, str2bool, vcf_candidates_from, contig_length_from
 from shared.interval_tree import bed_tree_from, is_region_in
 from src.create_tensor import get_chunk_id
 
@@ -49,9 +49,7 @@ no_of_positions = param.no_of_positions
 flanking_base_num = param.flankingBaseNum
 
 
-BASE2NUMBER = dict(zip("ACGTURYSWKMBDHVN-", (0, 1, 2, 3, 3, 0, 1, 1, 0, 2, 0, 1, 0, 0, 0, 0, 4)))
 NORMALIZE_NUM = param.NORMALIZE_NUM
-HAP_TYPE = dict(zip((1, 0, 2), (30, 60, 90)))  # hap1 UNKNOWN H2
 ACGT_NUM = dict(zip("ACGT+-*#N", (100, 25, 75, 50, -50, -100, 0, 0, 100)))
 
 #           0    1    2    3    4    5    6    7     8    9    10   11  12   13    14  15   16    17  18      19      20      21
@@ -374,15 +372,7 @@ def create_tensor(args):
         Whole genome calling option, acquire contig start end position from reference fasta index(.fai), then split the
         reference accroding to chunk id and total chunk numbers.
         """
-        contig_length = 0
-        with open(fai_fn, 'r') as fai_fp:
-            for row in fai_fp:
-                columns = row.strip().split("\t")
-
-                contig_name = columns[0]
-                if contig_name != ctg_name:
-                    continue
-                contig_length = int(columns[1])
+        contig_length = contig_length_from(fai_fn, ctg_name)
         chunk_size = contig_length // chunk_num + 1 if contig_length % chunk_num else contig_length // chunk_num
         ctg_start = chunk_size * chunk_id  # 0-base to 1-base
         ctg_end = ctg_start + chunk_size
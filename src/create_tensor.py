@@ -33,22 +33,35 @@ import shlex
 import logging
 import random
 
+# numpy is only available in the CPython environment; guarding the import
+# keeps `from src.create_tensor import get_chunk_id` working under pypy3
+try:
+    import numpy as np
+except ModuleNotFoundError:
+    np = None
+
+try:
+    from numba import njit
+except ModuleNotFoundError:
+    njit = None
+
 from subprocess import PIPE
 from copy import deepcopy
 from argparse import ArgumentParser, SUPPRESS
-from collections import Counter, defaultdict, OrderedDict
+from collections import Counter, defaultdict, deque
 
 import shared.param as param
 from shared.utils import subprocess_popen, file_path_from, IUPAC_base_to_num_dict as BASE2NUM, region_from, \
-    reference_sequence_from, str2bool, vcf_candidates_from
-from shared.interval_tree import bed_tree_from, is_region_in
+    reference_sequence_from, str2bool, vcf_candidates_from, contig_length_from, zstd_writer_from, \
+    threaded_batched_line_generator_from, widen_pipe_buffer
+from shared.interval_tree import bed_tree_from, is_region_in, region_mask_from
+from src._pileup_numba import decode_base_list, decode_base_list_with_counts, format_tensor_string
 
 logging.basicConfig(format='%(message)s', level=logging.INFO)
 BASES = set(list(BASE2NUM.keys()) + ["-"])
 no_of_positions = param.no_of_positions
 flanking_base_num = param.flankingBaseNum
 channel_size = param.channel_size
-BASE2NUMBER = dict(zip("ACGTURYSWKMBDHVN-", (0, 1, 2, 3, 3, 0, 1, 1, 0, 2, 0, 1, 0, 0, 0, 0, 4)))
 NORMALIZE_NUM = param.NORMALIZE_NUM
 ILMN_MAX_BQ = 40.0
 ONT_MAX_BQ = 60.0
@@ -56,7 +69,7 @@ MAX_MQ = 60.0
 MAX_AF = 1.0
 STRAND_0 = -100
 STRAND_1 = 100
-HAP_TYPE = dict(zip((1, 0, 2), (30, 60, 90)))  # hap1 UNKNOWN H2 # should be better using
+WRITE_BUFFER_SIZE = 1 << 20  # join tensor rows and flush to the writer in ~1 MB blocks
 NORMAL_HAP_TYPE = dict(zip((1, 0, 2), (13, 25, 37)))  # set normal hap tag
 # TUMOR_HAP_TYPE = dict(zip((1, 0, 2), (75, 88, 100)))  # set tumor hap tag
 TUMOR_HAP_TYPE = dict(zip((1, 0, 2), (50, 75, 100)))  # set tumor hap tag
@@ -68,6 +81,18 @@ TUMOR_HAP_TYPE = dict(zip((1, 0, 2), (30, 60, 90)))  # set tumor hap tag
 # NORMAL_HAP_TYPE = dict(zip((1, 0, 2), (13, 50, 37)))  # set normal hap tag
 # TUMOR_HAP_TYPE = dict(zip((1, 0, 2), (75, 100, 88)))  # set tumor hap tag
 ACGT_NUM = dict(zip("ACGT+-*#N", (100, 25, 75, 50, -50, -100, -100, -100, 100)))
+ACGT_INDEX = {'A': 0, 'a': 0, 'C': 1, 'c': 1, 'G': 2, 'g': 2, 'T': 3, 't': 3}
+REVERSE_STRAND_BASES = frozenset('#abcdefghijklmnopqrstuvwxyz')
+ACGT_NUM_LUT = None
+NORMAL_HAP_TYPE_ARR = None
+TUMOR_HAP_TYPE_ARR = None
+if np is not None:
+    ACGT_NUM_LUT = np.zeros(256, dtype=np.int8)
+    for _base, _num in ACGT_NUM.items():
+        ACGT_NUM_LUT[ord(_base)] = _num
+    # indexed by HP tag value 0/1/2
+    NORMAL_HAP_TYPE_ARR = np.array([NORMAL_HAP_TYPE[0], NORMAL_HAP_TYPE[1], NORMAL_HAP_TYPE[2]], dtype=np.int8)
+    TUMOR_HAP_TYPE_ARR = np.array([TUMOR_HAP_TYPE[0], TUMOR_HAP_TYPE[1], TUMOR_HAP_TYPE[2]], dtype=np.int8)
 
 
 def normalize_bq(x, platform='ont'):
@@ -83,6 +108,22 @@ def normalize_mq(x):
     x = 0 if x <= 20 else (20 if x <= 40 else 60)
     return int(NORMALIZE_NUM * min(x, MAX_MQ) / MAX_MQ)
 
+
+def normalize_bq_array(qual_array, platform='ont'):
+    # vectorized normalize_bq over a raw quality ndarray
+    MAX_BQ = ONT_MAX_BQ
+    if platform == "ilmn":
+        # only work for short reads
+        qual_array = qual_array // 10 * 10
+        MAX_BQ = ILMN_MAX_BQ
+    return (NORMALIZE_NUM * np.minimum(qual_array, MAX_BQ) / MAX_BQ).astype(np.int32)
+
+
+def normalize_mq_array(qual_array):
+    # vectorized normalize_mq over a raw quality ndarray
+    qual_array = np.where(qual_array <= 20, 0, np.where(qual_array <= 40, 20, 60))
+    return (NORMALIZE_NUM * np.minimum(qual_array, MAX_MQ) / MAX_MQ).astype(np.int32)
+
 def get_chunk_id(candidates_bed_regions):
     chunk_id, chunk_num, bin_size = "", "", ""
     try:
@@ -116,13 +157,32 @@ class Position(object):
         self.phase_set = phase_set
         self.genotype = genotype
         self.read_name_seq = defaultdict(str)
+        self._read_name_dict = None
+
+    @property
+    def read_name_dict(self):
+        # only find_tumor_alt_match reads this, and only at the center position,
+        # so skip building the dict for every windowed position
+        if self._read_name_dict is None:
+            self._read_name_dict = dict(zip(self.read_name_list, self.base_list))
+        return self._read_name_dict
 
     def update_infos(self, is_tumor=False, mask_low_bq=False, platform='ont'):
         # only proceed when variant exists in candidate windows which greatly improves efficiency
-        self.read_name_dict = dict(zip(self.read_name_list, self.base_list))
         self.update_info = True
-        self.mapping_quality = [normalize_mq(phredscore2raw_score(item)) for item in self.raw_mapping_quality]
-        self.base_quality = [normalize_bq(phredscore2raw_score(item), platform) for item in self.raw_base_quality]
+        # one C-level subtraction per quality string instead of per-character ord() calls
+        self.mapping_quality = normalize_mq_array(
+            np.frombuffer(self.raw_mapping_quality.encode('ascii'), dtype=np.uint8).astype(np.int32) - 33)
+        self.base_quality = normalize_bq_array(
+            np.frombuffer(self.raw_base_quality.encode('ascii'), dtype=np.uint8).astype(np.int32) - 33, platform)
+
+        channel_matrix = batch_tensor_channels(self.base_list, self.base_quality, self.mapping_quality,
+                                               self.ref_base, mask_low_bq, is_tumor)
+        if channel_matrix is not None:
+            for row_idx, (read_name, (base, indel)) in enumerate(zip(self.read_name_list, self.base_list)):
+                ins_base = indel[1:].upper() if base not in '*#' and indel != '' and indel[0] == '+' else ""
+                self.read_info[read_name] = (channel_matrix[row_idx], ins_base)
+            return
 
         for read_name, base_info, bq, mq in zip(self.read_name_list, self.base_list, self.base_quality,
                                                 self.mapping_quality):
@@ -158,25 +218,28 @@ def sorted_by_hap_read_name(center_pos, haplotag_dict, pileup_dict, hap_dict, ma
     while haplotype information directly acquire from BAM HP tag.
     platform: select maximum depth for each platform.
     """
-    all_nearby_read_name = []
     start_pos, end_pos = center_pos - flanking_base_num, center_pos + flanking_base_num + 1
+    # dict.fromkeys dedupes in first-seen order at C speed, no per-name set probe
+    nearby_read_name_dict = {}
     for p in range(start_pos, end_pos):
-        if p in pileup_dict.keys():
-            all_nearby_read_name += pileup_dict[p].read_name_list
-    all_nearby_read_name = list(OrderedDict.fromkeys(all_nearby_read_name))  # have sorted by order
+        position = pileup_dict.get(p)
+        if position is None:
+            continue
+        nearby_read_name_dict.update(dict.fromkeys(position.read_name_list))
+    all_nearby_read_name = list(nearby_read_name_dict)
     matrix_depth = max_depth
     if len(all_nearby_read_name) > matrix_depth and not use_tensor_sample_mode:
-        # set same seed for reproducibility
-        random.seed(0)
-        indices = random.sample(range(len(all_nearby_read_name)), matrix_depth)
-        all_nearby_read_name = [all_nearby_read_name[i] for i in sorted(indices)]
-    sorted_read_name_list = []
-    for order, read_name in enumerate(all_nearby_read_name):
-        hap = max(haplotag_dict[read_name], hap_dict[read_name])  # no phasing is 0
-        sorted_read_name_list.append((hap, order, read_name))
-
-    sorted_read_name_list = sorted(sorted_read_name_list, key=lambda x: x[1])
-    return sorted_read_name_list
+        # fixed seed for reproducibility, C-level sampling without replacement
+        rng = np.random.default_rng(0)
+        indices = np.sort(rng.choice(len(all_nearby_read_name), matrix_depth, replace=False))
+        all_nearby_read_name = [all_nearby_read_name[i] for i in indices]
+    haplotag_get, hap_get = haplotag_dict.get, hap_dict.get
+    # SoA layout: parallel hap/order arrays plus the read name list, no per-read tuples
+    read_haps = np.fromiter((max(haplotag_get(read_name, 0), hap_get(read_name, 0))  # no phasing is 0
+                             for read_name in all_nearby_read_name),
+                            dtype=np.int8, count=len(all_nearby_read_name))
+    read_orders = np.arange(len(all_nearby_read_name), dtype=np.int32)
+    return read_haps, read_orders, all_nearby_read_name
 
 
 def get_tensor_info(base_info, bq, ref_base, mask_low_bq=False, read_mq=None, is_tumor=False):
@@ -195,7 +258,7 @@ def get_tensor_info(base_info, bq, ref_base, mask_low_bq=False, read_mq=None, is
     query_base = ""
     read_channel = [0] * channel_size
     if base[0] in '*#':
-        read_channel[1] = ACGT_NUM[base[0]]
+        read_channel[1] = ACGT_NUM_LUT[ord(base[0])]
         return read_channel, ins_base, query_base
     strand = STRAND_1
     if base[0] in 'ACGT':
@@ -204,15 +267,15 @@ def get_tensor_info(base_info, bq, ref_base, mask_low_bq=False, read_mq=None, is
 
     base_upper = base.upper()
     if indel != '':
-        ALT_BASE = ACGT_NUM[indel[0]]
+        ALT_BASE = ACGT_NUM_LUT[ord(indel[0])]
     elif (base_upper != ref_base and base_upper in 'ACGT'):
         base_upper = evc_base_from(base_upper)
-        ALT_BASE = ACGT_NUM[base_upper]
+        ALT_BASE = ACGT_NUM_LUT[ord(base_upper)]
         if mask_low_bq and bq < 33 and ALT_BASE:  # bq < 20
             ALT_BASE = 0
             bq = 0
 
-    REF_BASE = ACGT_NUM[ref_base]
+    REF_BASE = ACGT_NUM_LUT[ord(ref_base)]
     if len(indel) and indel[0] in '+-':
         if indel[0] == "+":
             ins_base = indel[1:].upper()
@@ -221,6 +284,61 @@ def get_tensor_info(base_info, bq, ref_base, mask_low_bq=False, read_mq=None, is
     return read_channel, ins_base, query_base
 
 
+_tensor_channel_kernel = None
+if njit is not None:
+    @njit(cache=True, nogil=True)
+    def _tensor_channel_kernel(base_code, indel_first, bq, mq, hp, ref_code, is_tumor, mask_low_bq, out):
+        # batch get_tensor_info over every read covering one position
+        ref_num = ACGT_NUM_LUT[ref_code]
+        for i in range(base_code.shape[0]):
+            b = base_code[i]
+            if b == 35 or b == 42:  # '#' or '*'
+                out[i, 1] = ACGT_NUM_LUT[b]
+                continue
+            strand = STRAND_1
+            if b == 65 or b == 67 or b == 71 or b == 84:  # uppercase ACGT, forward strand
+                strand = STRAND_0
+            base_upper = b & 0xDF
+            alt_num = 0
+            read_bq = bq[i]
+            if indel_first[i] != 0:
+                alt_num = ACGT_NUM_LUT[indel_first[i]]
+            elif base_upper != ref_code and base_upper != 78:  # mismatch, 'N' carries no alt
+                alt_num = ACGT_NUM_LUT[base_upper]
+                if mask_low_bq and read_bq < 33 and alt_num != 0:  # bq < 20
+                    alt_num = 0
+                    read_bq = 0
+            out[i, 0] = ref_num
+            out[i, 1] = alt_num
+            out[i, 2] = strand
+            out[i, 3] = read_bq
+            out[i, 4] = mq[i]
+            out[i, 5] = TUMOR_HAP_TYPE_ARR[hp[i]] if is_tumor else NORMAL_HAP_TYPE_ARR[hp[i]]
+
+
+def batch_tensor_channels(base_list, base_quality, mapping_quality, ref_base, mask_low_bq, is_tumor, hap_list=None):
+    """
+    Compute the first six tensor channels for all reads covering one position
+    in a single numba call, returns an (N, channel_size) int8 matrix whose rows
+    replace the per-read read_channel lists. Returns None when numba is not
+    available and callers should fall back to scalar get_tensor_info.
+    """
+    if _tensor_channel_kernel is None:
+        return None
+    n = len(base_list)
+    base_code = np.empty(n, dtype=np.uint8)
+    indel_first = np.zeros(n, dtype=np.uint8)
+    for i, (base, indel) in enumerate(base_list):
+        base_code[i] = ord(base)
+        if indel != '':
+            indel_first[i] = ord(indel[0])
+    hp = np.zeros(n, dtype=np.int8) if hap_list is None else np.array(hap_list, dtype=np.int8)
+    out = np.zeros((n, channel_size), dtype=np.int8)
+    _tensor_channel_kernel(base_code, indel_first, base_quality, mapping_quality, hp,
+                           ord(ref_base), is_tumor, mask_low_bq, out)
+    return out
+
+
 def decode_pileup_bases(pos, pileup_bases, reference_base, minimum_snv_af_for_candidate, minimum_indel_af_for_candidate,
                         has_pileup_candidates, candidates_type_dict, is_tumor, platform="ont"):
     """
@@ -234,82 +352,62 @@ def decode_pileup_bases(pos, pileup_bases, reference_base, minimum_snv_af_for_ca
     has_pileup_candidates: if the candidate is directly obtained from pileup output, then no need to check the af filtering.
     """
 
-    base_idx = 0
-    base_list = []
-    while base_idx < len(pileup_bases):
-        base = pileup_bases[base_idx]
-        if base == '+' or base == '-':
-            base_idx += 1
-            advance = 0
-            while True:
-                num = pileup_bases[base_idx]
-                if num.isdigit():
-                    advance = advance * 10 + int(num)
-                    base_idx += 1
-                else:
-                    break
-            base_list[-1][1] = base + pileup_bases[base_idx: base_idx + advance]  # add indel seq
-            base_idx += advance - 1
-
-        elif base in "ACGTNacgtn#*":
-            base_list.append([base, ""])
-        elif base == '^':  # start of read, next base is mq, update mq info
-            base_idx += 1
-        # skip $, the end of read
-        base_idx += 1
-    if has_pileup_candidates:
-        if pos not in candidates_type_dict or not is_tumor:
-            return base_list, None, True, 1.0
-    pileup_dict = defaultdict(int)
-    base_counter = Counter([''.join(item) for item in base_list])
-    depth = 0
-    for key, count in base_counter.items():
-        if key[0].upper() in 'ACGT':
-            pileup_dict[key[0].upper()] += count
-            depth += count
-        elif key[0] in "#*":
-            depth += count
-        if len(key) > 1 and key[1] == '+':
-            pileup_dict['I'] += count
-        elif len(key) > 1 and key[1] == '-':
-            pileup_dict['D'] += count
+    if has_pileup_candidates and (pos not in candidates_type_dict or not is_tumor):
+        return decode_base_list(pileup_bases), None, True, 1.0
+
+    base_list, counts, depth = decode_base_list_with_counts(pileup_bases)
+    if counts is None:
+        # scalar fallback, single pass over base_list
+        counts = [0, 0, 0, 0, 0, 0]  # A C G T I D
+        depth = 0
+        for base, indel in base_list:
+            base_index = ACGT_INDEX.get(base, -1)
+            if base_index >= 0:
+                counts[base_index] += 1
+                depth += 1
+            elif base in "#*":
+                depth += 1
+            if indel != '':
+                counts[4 if indel[0] == '+' else 5] += 1
 
     minimum_snv_af_for_candidate = minimum_snv_af_for_candidate if minimum_snv_af_for_candidate > 0 else param.min_af
     minimum_indel_af_for_candidate = minimum_indel_af_for_candidate if minimum_indel_af_for_candidate > 0 else param.min_af
 
     denominator = depth if depth > 0 else 1
-    pileup_list = sorted(list(pileup_dict.items()), key=lambda x: x[1], reverse=True)
-
-    pass_snv_af = False
-    pass_indel_af = False
-
-    for item, count in pileup_list:
-        if pass_snv_af or pass_indel_af:
-            break
-        if item == reference_base:
-            continue
-        elif item[0] in 'ID':
-            pass_indel_af = (pass_indel_af or (float(count) / denominator >= minimum_indel_af_for_candidate))
-            continue
-        pass_snv_af = pass_snv_af or (float(count) / denominator >= minimum_snv_af_for_candidate)
-
-    af = (float(pileup_list[1][1]) / denominator) if len(pileup_list) > 1 else 0.0
-    af = (float(pileup_list[0][1]) / denominator) if len(pileup_list) >= 1 and pileup_list[0][
-        0] != reference_base else af
+    # vectorized AF checks over the six counts, no sorted allele list needed
+    counts_arr = np.asarray(counts, dtype=np.int32)
+    af_array = counts_arr / denominator
+    ref_index = ACGT_INDEX.get(reference_base, -1)
+    nonref_mask = np.ones(4, dtype=bool)
+    if ref_index >= 0:
+        nonref_mask[ref_index] = False
+    pass_snv_af = bool((af_array[:4][nonref_mask] >= minimum_snv_af_for_candidate).any())
+    pass_indel_af = bool((af_array[4:] >= minimum_indel_af_for_candidate).any())
+
+    # af follows the old sorted-list rule: top non-reference count, otherwise runner-up
+    top_index = int(np.argmax(counts_arr))
+    top_count = int(counts_arr[top_index])
+    if top_count == 0:
+        af = 0.0
+    elif top_index != ref_index:
+        af = float(top_count) / denominator
+    else:
+        counts_arr[top_index] = 0
+        af = float(counts_arr.max()) / denominator
 
     pass_af = pass_snv_af or pass_indel_af
 
     return base_list, depth, pass_af, af
 
 
-def find_tumor_alt_match(center_pos, sorted_read_name_list, pileup_dict, truths_variant_dict, proportion=None):
+def find_tumor_alt_match(center_pos, read_name_list, pileup_dict, truths_variant_dict, proportion=None):
     if proportion is not None and float(proportion) == 1.0:
         # all reads are from tumor reads
-        tumor_reads = [read_name for (hap, _, read_name) in sorted_read_name_list]
+        tumor_reads = list(read_name_list)
         normal_reads = []
     else:
-        tumor_reads = [read_name for (hap, _, read_name) in sorted_read_name_list if read_name.startswith('t')]
-        normal_reads = [read_name for (hap, _, read_name) in sorted_read_name_list if read_name.startswith('n')]
+        tumor_reads = [read_name for read_name in read_name_list if read_name.startswith('t')]
+        normal_reads = [read_name for read_name in read_name_list if read_name.startswith('n')]
     ref_base, alt_base = truths_variant_dict[center_pos].reference_bases, \
                          truths_variant_dict[center_pos].alternate_bases[0]
     is_ins = len(alt_base) > 1 and len(ref_base) == 1
@@ -319,9 +417,11 @@ def find_tumor_alt_match(center_pos, sorted_read_name_list, pileup_dict, truths_
     matched_read_name_set = set()
     normal_read_name_set = set(normal_reads)
     tumor_read_name_set = set(tumor_reads)
+    center_read_name_dict = pileup_dict[center_pos].read_name_dict
     for read_name in tumor_reads:
-        if read_name in pileup_dict[center_pos].read_name_dict:
-            base, indel = pileup_dict[center_pos].read_name_dict[read_name]
+        base_info = center_read_name_dict.get(read_name)
+        if base_info is not None:
+            base, indel = base_info
             base_upper = base.upper()
             if is_ins and base_upper + indel[1:].upper() == alt_base:
                 matched_read_name_set.add(read_name)
@@ -335,7 +435,7 @@ def find_tumor_alt_match(center_pos, sorted_read_name_list, pileup_dict, truths_
 def generate_tensor(args,
                     ctg_name,
                     center_pos,
-                    sorted_read_name_list,
+                    sorted_read_name_infos,
                     pileup_dict,
                     ref_seq,
                     reference_sequence,
@@ -355,7 +455,7 @@ def generate_tensor(args,
     ctg_name: provided contig name.
     center_pos: center position for full alignment generation, default window size = no_of_positions =
     flankingBaseNum + 1 + flankingBaseNum
-    sorted_read_name_list: read name list which have been sorted by read start position and haplotype.
+    sorted_read_name_infos: parallel hap/order arrays and read name list, sorted by read start position and haplotype.
     pileup_dict: dictionary (pos: pos info) which keep read information that cover specific position .
     ref_seq: chunked reference sequence in window, start: center pos - flankingBaseNum, end: center + flankingBaseNum + 1.
     reference_sequence: reference sequence index by contig:start-end. 0-based.
@@ -369,13 +469,15 @@ def generate_tensor(args,
 
     tensor_shape = param.ont_input_shape if platform == 'ont' else param.input_shape
     reference_base = ref_seq[flanking_base_num]
-    tensor_depth = len(sorted_read_name_list)
+    read_haps, read_orders, read_name_list = sorted_read_name_infos
+    tensor_depth = len(read_name_list)
 
     use_alt_base = False if platform == 'ont' else param.use_alt_base
 
     if tensor_depth == 0:
         return None, None
-    tensor = [[[0] * tensor_shape[2] for _ in range(tensor_shape[1])] for _ in range(tensor_depth)]
+    # all stored channel values are within int8 range, ~8x smaller than nested lists
+    tensor = np.zeros((tensor_depth, tensor_shape[1], tensor_shape[2]), dtype=np.int8)
     start_pos, end_pos = center_pos - flanking_base_num, center_pos + flanking_base_num + 1
     insert_tuple = []
 
@@ -386,22 +488,30 @@ def generate_tensor(args,
     if not pass_confident_bed:
         return None, None
 
+    # iterate each position's covering reads instead of all depth x window cells
+    center_position = pileup_dict[center_pos]
+    candidate_type = candidates_type_dict.get(center_pos)
+    read_index_of = {read_name: read_idx for read_idx, read_name in enumerate(read_name_list)}
     for p in range(start_pos, end_pos):
-        if p in pileup_dict and not pileup_dict[p].update_info:
-            pileup_dict[p].update_infos(is_tumor=is_tumor, mask_low_bq=args.mask_low_bq, platform=platform)
-        for read_idx, read_name_info in enumerate(sorted_read_name_list):
-            hap, read_order, read_name = read_name_info
-            offset = p - start_pos
-            if p in pileup_dict and read_name in pileup_dict[p].read_info:
-                read_channel, ins_base = pileup_dict[p].read_info[read_name]
-                tensor[read_idx][offset] = read_channel
-                if ins_base != '' and p < end_pos - 1:
-                    insert_tuple.append((read_idx, offset, ins_base, p))
+        position = pileup_dict.get(p)
+        if position is None:
+            continue
+        if not position.update_info:
+            position.update_infos(is_tumor=is_tumor, mask_low_bq=args.mask_low_bq, platform=platform)
+        offset = p - start_pos
+        collect_ins = p < end_pos - 1
+        for read_name, (read_channel, ins_base) in position.read_info.items():
+            read_idx = read_index_of.get(read_name)
+            if read_idx is None:
+                continue
+            tensor[read_idx, offset] = read_channel
+            if ins_base != '' and collect_ins:
+                insert_tuple.append((read_idx, offset, ins_base, p))
 
     for read_idx, p, ins_base, center_p in insert_tuple:
-
-        for ins_idx in range(min(len(ins_base), no_of_positions - p)):
-            tensor[read_idx][ins_idx + p][6] = ACGT_NUM[ins_base[ins_idx]]
+        ins_length = min(len(ins_base), no_of_positions - p)
+        ins_codes = np.frombuffer(ins_base[:ins_length].encode('ascii'), dtype=np.uint8)
+        tensor[read_idx, p: p + ins_length, 6] = ACGT_NUM_LUT[ins_codes]
 
     matrix_depth = param.tumor_matrix_depth_dict[platform] if is_tumor else param.normal_matrix_depth_dict[platform]
 
@@ -414,13 +524,16 @@ def generate_tensor(args,
     # gradient = each reads
     if use_tensor_sample_mode:
 
-        if len(sorted_read_name_list) > matrix_depth:
-            # set same seed for reproducibility
+        if len(read_name_list) > matrix_depth:
+            # set same seed for reproducibility, sample indices so all three arrays stay aligned
             random.seed(0)
-            sorted_read_name_list = random.sample(sorted_read_name_list, matrix_depth)
+            sampled_indices = random.sample(range(len(read_name_list)), matrix_depth)
+            read_haps = read_haps[sampled_indices]
+            read_orders = read_orders[sampled_indices]
+            read_name_list = [read_name_list[i] for i in sampled_indices]
 
         tumor_reads_meet_alt_info_set, normal_read_name_set, tumor_read_name_set = find_tumor_alt_match(center_pos,
-                                                                                                        sorted_read_name_list,
+                                                                                                        read_name_list,
                                                                                                         pileup_dict,
                                                                                                         truths_variant_dict,
                                                                                                         proportion=proportion)
@@ -487,7 +600,7 @@ def generate_tensor(args,
             af_set = set()
             tmp_read_name_list = []
             alt_base_num = 0
-            for row_idx, (hap, _, read_name) in enumerate(sorted_read_name_list):
+            for row_idx, read_name in enumerate(read_name_list):
                 if read_name in re_sorted_read_name_set:
                     if use_alt_base and read_name not in sampled_tumor_read_name_meet_alt_set and \
                             tensor[row_idx][flanking_base_num][1] == ACGT_NUM[
@@ -500,8 +613,8 @@ def generate_tensor(args,
                         tmp_tensor.append(tensor[row_idx])
                     tmp_read_name_list.append(read_name)
             alt_dict = defaultdict(int)
-            for read_name, (base, indel) in zip(pileup_dict[center_pos].read_name_list,
-                                                pileup_dict[center_pos].base_list):
+            for read_name, (base, indel) in zip(center_position.read_name_list,
+                                                center_position.base_list):
                 if base in "#*":
                     continue
                 if read_name not in re_sorted_read_name_set:
@@ -532,37 +645,34 @@ def generate_tensor(args,
             alt_info = str(tmp_depth) + '-' + ' '.join(
                 [' '.join([item[0], str(item[1])]) for item in alt_info]) + '-' + af_infos
             alt_info_list.append(alt_info)
-            tensor_string_list.append(" ".join(
-                (" ".join(" ".join(str(x) for x in innerlist) for innerlist in outerlist)) for outerlist in tmp_tensor))
+            tensor_string_list.append(format_tensor_string(tmp_tensor))
 
-            if add_hetero_phasing and (candidates_type_dict[center_pos] != 'homo_somatic' or float(proportion) == 1.0):
+            if add_hetero_phasing and (candidate_type != 'homo_somatic' or float(proportion) == 1.0):
                 HAP_TYPE = TUMOR_HAP_TYPE if is_tumor else NORMAL_HAP_TYPE
                 unphased_num = TUMOR_HAP_TYPE[0] if is_tumor else NORMAL_HAP_TYPE[0]
-                all_hap = [item[0] for item in sorted_read_name_list]
                 # skip if no phased reads exist
-                if sum(all_hap) != 0:
+                if read_haps.sum() != 0:
 
                     # require phasable haplotype for hetero somatic
-                    if candidates_type_dict[center_pos] == 'hetero_somatic':
-                        hap_counter = Counter([hap_dict[rn] for rn in sampled_tumor_read_name_meet_alt_set])
+                    if candidate_type == 'hetero_somatic':
+                        hap_counter = Counter([hap_dict.get(rn, 0) for rn in sampled_tumor_read_name_meet_alt_set])
                         if hap_counter[1] * hap_counter[2] > 0 or (hap_counter[1] < 3 and hap_counter[2] < 3):
                             continue
 
-                    sorted_phased_read_name_list = sorted(sorted_read_name_list, key=lambda x: (x[0], x[1]))
-                    phase_read_name_index_mapping = [item[1] for item in sorted_phased_read_name_list]
+                    # vectorized (hap, order) sort, orders are unique within the window
+                    phased_perm = np.argsort((read_haps.astype(np.int64) << 32) | read_orders)
+                    phase_read_name_index_mapping = read_orders[phased_perm]
 
                     phased_tensor = [deepcopy(tensor[read_idx]) for read_idx in phase_read_name_index_mapping]
 
                     for row_idx in range(len(phased_tensor)):
-                        hap = sorted_phased_read_name_list[row_idx][0]
+                        hap = int(read_haps[phased_perm[row_idx]])
                         if hap in HAP_TYPE:
                             for p in range(no_of_positions):
                                 if phased_tensor[row_idx][p][5] == unphased_num:
                                     phased_tensor[row_idx][p][5] = HAP_TYPE[hap]
 
-                    phasing_tensor_string = " ".join(
-                        (" ".join(" ".join(str(x) for x in innerlist) for innerlist in outerlist)) for outerlist in
-                        phased_tensor)
+                    phasing_tensor_string = format_tensor_string(phased_tensor)
                     if keep_phase_only:
 
                         tensor_string_list[-1] = phasing_tensor_string
@@ -570,22 +680,17 @@ def generate_tensor(args,
                         tensor_string_list.append(phasing_tensor_string)
                         alt_info_list.append(alt_info)
 
-        variant_type = candidates_type_dict[center_pos] if center_pos in candidates_type_dict else 'unknown'
+        variant_type = candidate_type if candidate_type is not None else 'unknown'
 
-        return '\n'.join(["%s\t%d\t%s\t%s\t%s\t%s\t%s" % (
-            ctg_name,
-            center_pos,
-            ref_seq,
-            tensor_string,
-            alt_info,
-            "tumor" if is_tumor else "normal",
-            variant_type
-        ) for tensor_string, alt_info in zip(tensor_string_list, alt_info_list)]), ""
+        prefix = ctg_name + '\t' + str(center_pos) + '\t' + ref_seq + '\t'
+        suffix = '\t' + ("tumor" if is_tumor else "normal") + '\t' + variant_type
+        return '\n'.join([prefix + tensor_string + '\t' + alt_info + suffix
+                          for tensor_string, alt_info in zip(tensor_string_list, alt_info_list)]), ""
 
     else:
         alt_dict = defaultdict(int)
         depth, max_del_length = 0, 0
-        for base, indel in pileup_dict[center_pos].base_list:
+        for base, indel in center_position.base_list:
             if base in "#*":
                 depth += 1
                 continue
@@ -615,54 +720,48 @@ def generate_tensor(args,
                 alt_info.append(['X' + alt_type, str(alt_count)])
         alt_info = str(depth) + '-' + ' '.join(
             [' '.join([item[0], str(item[1])]) for item in alt_info]) + '-' + af_infos
-        tensor_string_list = [" ".join(
-            (" ".join(" ".join(str(x) for x in innerlist) for innerlist in outerlist)) for outerlist in tensor)]
+        tensor_string_list = [format_tensor_string(tensor)]
 
-        if add_hetero_phasing and candidates_type_dict[center_pos] != 'homo_somatic':
+        if add_hetero_phasing and candidate_type != 'homo_somatic':
             HAP_TYPE = TUMOR_HAP_TYPE if is_tumor else NORMAL_HAP_TYPE
             unphased_num = TUMOR_HAP_TYPE[0] if is_tumor else NORMAL_HAP_TYPE[0]
-            all_hap = [item[0] for item in sorted_read_name_list]
             # skip if no phased reads exist
-            if sum(all_hap) != 0:
-                sorted_phased_read_name_list = sorted(sorted_read_name_list, key=lambda x: (x[0], x[1]))
-                phase_read_name_index_mapping = [item[1] for item in sorted_phased_read_name_list]
+            if read_haps.sum() != 0:
+                # vectorized (hap, order) sort, orders are unique within the window
+                phased_perm = np.argsort((read_haps.astype(np.int64) << 32) | read_orders)
+                phase_read_name_index_mapping = read_orders[phased_perm]
 
                 phased_tensor = [tensor[read_idx] for read_idx in phase_read_name_index_mapping]
 
                 for row_idx in range(len(phased_tensor)):
-                    hap = sorted_phased_read_name_list[row_idx][0]
+                    hap = int(read_haps[phased_perm[row_idx]])
                     if hap in HAP_TYPE:
                         for p in range(no_of_positions):
                             if phased_tensor[row_idx][p][5] == unphased_num:
                                 phased_tensor[row_idx][p][5] = HAP_TYPE[hap]
 
-                phasing_tensor_string = " ".join(
-                    (" ".join(" ".join(str(x) for x in innerlist) for innerlist in outerlist)) for outerlist in
-                    phased_tensor)
+                phasing_tensor_string = format_tensor_string(phased_tensor)
 
                 if keep_phase_only:
                     tensor_string_list[-1] = phasing_tensor_string
                 else:
                     tensor_string_list.append(phasing_tensor_string)
 
-        variant_type = candidates_type_dict[center_pos] if center_pos in candidates_type_dict else 'unknown'
+        variant_type = candidate_type if candidate_type is not None else 'unknown'
 
-        return '\n'.join(["%s\t%d\t%s\t%s\t%s\t%s\t%s" % (
-            ctg_name,
-            center_pos,
-            ref_seq,
-            tensor_string,
-            alt_info,
-            "tumor" if is_tumor else "normal",
-            variant_type
-        ) for tensor_string in tensor_string_list]), alt_info
+        prefix = ctg_name + '\t' + str(center_pos) + '\t' + ref_seq + '\t'
+        suffix = '\t' + alt_info + '\t' + ("tumor" if is_tumor else "normal") + '\t' + variant_type
+        return '\n'.join([prefix + tensor_string + suffix
+                          for tensor_string in tensor_string_list]), alt_info
 
 
 class TensorStdout(object):
     def __init__(self, handle):
         self.stdin = handle
 
-    def __del__(self):
+    def close(self):
+        # explicit close instead of a __del__ finalizer, flushing is deterministic
+        # and no reference cycle keeps the handle alive until interpreter shutdown
         self.stdin.close()
 
 
@@ -697,7 +796,7 @@ def create_tensor(args):
     global test_pos
     test_pos = None
     candidates_pos_set = set()
-    candidates_type_dict = defaultdict(str)
+    candidates_type_dict = {}
     add_read_regions = True
     training_mode = args.training_mode
     truth_vcf_fn = args.truth_vcf_fn
@@ -745,15 +844,7 @@ def create_tensor(args):
         Whole genome calling option, acquire contig start end position from reference fasta index(.fai), then split the
         reference accroding to chunk id and total chunk numbers.
         """
-        contig_length = 0
-        with open(fai_fn, 'r') as fai_fp:
-            for row in fai_fp:
-                columns = row.strip().split("\t")
-
-                contig_name = columns[0]
-                if contig_name != ctg_name:
-                    continue
-                contig_length = int(columns[1])
+        contig_length = contig_length_from(fai_fn, ctg_name)
         chunk_size = contig_length // chunk_num + 1 if contig_length % chunk_num else contig_length // chunk_num
         ctg_start = chunk_size * chunk_id  # 0-base to 1-base
         ctg_end = ctg_start + chunk_size
@@ -793,6 +884,8 @@ def create_tensor(args):
     )
     if reference_sequence is None or len(reference_sequence) == 0:
         sys.exit("[ERROR] Failed to load reference sequence from file ({}).".format(fasta_file_path))
+    # uppercase once at load so per-candidate slices skip their own copies
+    reference_sequence = reference_sequence.upper()
 
     phasing_option = " --output-extra HP" if phasing_info_in_bam else " "
     mq_option = ' --min-MQ {}'.format(min_mapping_quality)
@@ -813,24 +906,25 @@ def create_tensor(args):
     samtools_command = "{} mpileup {} --reverse-del".format(samtools_execute_command, bam_file_path) + \
                        output_read_name_option + output_mq_option + reads_regions_option + phasing_option + mq_option + bq_option + bed_option + flags_option + max_depth_option
     samtools_mpileup_process = subprocess_popen(
-        shlex.split(samtools_command), stdin=stdin)
+        shlex.split(samtools_command), stdin=stdin, text=False)
+    widen_pipe_buffer(samtools_mpileup_process.stdout)
 
     is_tumor = "tumor_" in bam_file_path or tensor_sample_mode != 0
 
     if tensor_can_output_path != "PIPE":
-        tensor_can_fpo = open(tensor_can_output_path, "wb")
-        tensor_can_fp = subprocess_popen(shlex.split("{} -c".format(args.zstd)), stdin=PIPE, stdout=tensor_can_fpo)
+        tensor_can_fp, tensor_can_fpo = zstd_writer_from(tensor_can_output_path, args.zstd)
     else:
         tensor_can_fp = TensorStdout(sys.stdout)
 
     if alt_fn:
         output_alt_fn = alt_fn
-        alt_fpo = open(output_alt_fn, "wb")
-        alt_fp = subprocess_popen(shlex.split("{} -c".format(args.zstd)), stdin=PIPE, stdout=alt_fpo)
+        alt_fp, alt_fpo = zstd_writer_from(output_alt_fn, args.zstd)
 
-    hap_dict = defaultdict(int)
-    haplotag_dict = defaultdict(int)
-    pileup_dict = defaultdict(str)
+    # plain dicts: every entry is assigned explicitly, no __missing__ inserts
+    hap_dict = {}
+    haplotag_dict = {}
+    pileup_dict = {}
+    pileup_pos_deque = deque()  # insertion (= position) order, for O(1) window eviction
     extend_bp_distance = no_of_positions + param.extend_bp
     confident_bed_tree = bed_tree_from(bed_file_path=confident_bed_fn,
                                        contig_name=ctg_name,
@@ -841,18 +935,26 @@ def create_tensor(args):
                                     contig_name=ctg_name,
                                     bed_ctg_start=extend_start,
                                     bed_ctg_end=extend_end)
+    # flatten the extend bed into a boolean per-position mask when the row
+    # positions are bounded, one indexed load per row instead of a tree query
+    extend_bed_mask = region_mask_from(extend_bed_tree, ctg_name, extend_start, extend_end) \
+        if is_extend_bed_file_given and extend_start is not None else None
 
     def samtools_pileup_generator_from(samtools_mpileup_process):
         candidate_pos_list = sorted(list(candidates_pos_set))
         current_pos_index = 0
+        # the pending candidate is cached so the per-row guard is one compare
+        cp_target = candidate_pos_list[0] if candidate_pos_list else sys.maxsize
         has_pileup_candidates = len(candidates_pos_set)
-        for row in samtools_mpileup_process.stdout:  # chr position N depth seq BQ read_name mapping_quality phasing_info
-            columns = row.strip().split('\t')
+        # chunked reads and decode run in a background thread so samtools keeps
+        # writing while this loop parses
+        for row in threaded_batched_line_generator_from(samtools_mpileup_process.stdout):  # chr position N depth seq BQ read_name mapping_quality phasing_info
+            columns = row.split('\t')
             pos = int(columns[1])
             # pos that near bed region should include some indel cover in bed
-            pass_extend_bed = not is_extend_bed_file_given or is_region_in(extend_bed_tree,
-                                                                           ctg_name, pos - 1,
-                                                                           pos + 1)
+            pass_extend_bed = not is_extend_bed_file_given or \
+                (extend_bed_mask[pos - extend_start] if extend_bed_mask is not None
+                 else is_region_in(extend_bed_tree, ctg_name, pos - 1, pos + 1))
             pass_ctg_range = not ctg_start or (pos >= ctg_start and pos <= ctg_end)
             if not has_pileup_candidates and not pass_extend_bed and pass_ctg_range:
                 continue
@@ -860,7 +962,7 @@ def create_tensor(args):
             raw_base_quality = columns[5]
             raw_mapping_quality = columns[6]
             read_name_list = columns[7].split(',')
-            reference_base = reference_sequence[pos - reference_start].upper()
+            reference_base = reference_sequence[pos - reference_start]
             if reference_base not in 'ACGT':
                 continue
             base_list, depth, pass_af, af = decode_pileup_bases(pos=pos,
@@ -872,11 +974,11 @@ def create_tensor(args):
                                                                 candidates_type_dict=candidates_type_dict,
                                                                 is_tumor=is_tumor)
 
-            for b_idx, base in enumerate(base_list):
-                if base[0] == '#' or (base[0] >= 'a' and base[0] <= 'z'):
-                    read_name_list[b_idx] += '_1'  # reverse
-                else:
-                    read_name_list[b_idx] += '_0'  # forward
+            if len(read_name_list) != len(base_list):
+                continue
+            # single zip pass, no per-base index assignment ('_1' reverse, '_0' forward)
+            read_name_list = [read_name + ('_1' if base in REVERSE_STRAND_BASES else '_0')
+                              for read_name, (base, _) in zip(read_name_list, base_list)]
 
             if phasing_info_in_bam:
                 phasing_info = columns[8].split(',')
@@ -887,16 +989,18 @@ def create_tensor(args):
                         if hap in '12' and read_name_list[hap_idx] not in hap_dict:
                             hap_dict[read_name_list[hap_idx]] = int(hap)
 
-            if len(read_name_list) != len(base_list):
-                continue
-
             if not is_known_vcf_file_provided and not has_pileup_candidates and reference_base in 'ACGT' and (
                     pass_af and depth >= min_coverage):
                 candidate_pos_list.append(pos)
+                if current_pos_index == len(candidate_pos_list) - 1:
+                    cp_target = pos
 
             if is_known_vcf_file_provided and not has_pileup_candidates and pos in known_variants_set:
                 candidate_pos_list.append(pos)
+                if current_pos_index == len(candidate_pos_list) - 1:
+                    cp_target = pos
 
+            pileup_pos_deque.append(pos)
             pileup_dict[pos] = Position(pos=pos,
                                         ref_base=reference_base,
                                         read_name_list=read_name_list,
@@ -908,43 +1012,42 @@ def create_tensor(args):
 
             # overlap_hetero_region = hetero_snv_tree.at(pos)
 
-            if current_pos_index < len(candidate_pos_list) and pos - candidate_pos_list[
-                current_pos_index] > extend_bp_distance:
-                yield candidate_pos_list[current_pos_index]
-                for pre_pos in sorted(pileup_dict.keys()):
-                    if candidate_pos_list[current_pos_index] - pre_pos > extend_bp_distance:
-                        del pileup_dict[pre_pos]
-                    else:
-                        break
+            if pos - cp_target > extend_bp_distance:
+                yield cp_target
+                while pileup_pos_deque and cp_target - pileup_pos_deque[0] > extend_bp_distance:
+                    del pileup_dict[pileup_pos_deque.popleft()]
                 current_pos_index += 1
+                cp_target = candidate_pos_list[current_pos_index] \
+                    if current_pos_index < len(candidate_pos_list) else sys.maxsize
         while current_pos_index != len(candidate_pos_list):
             yield candidate_pos_list[current_pos_index]
-            for pre_pos in sorted(pileup_dict.keys()):
-                if candidate_pos_list[current_pos_index] - pre_pos > extend_bp_distance:
-                    del pileup_dict[pre_pos]
-                else:
-                    break
+            while pileup_pos_deque and \
+                    candidate_pos_list[current_pos_index] - pileup_pos_deque[0] > extend_bp_distance:
+                del pileup_dict[pileup_pos_deque.popleft()]
             current_pos_index += 1
 
     samtools_pileup_generator = samtools_pileup_generator_from(samtools_mpileup_process)
 
+    tensor_buffer = []
+    tensor_buffer_len = 0
     for pos in samtools_pileup_generator:
         if pos not in pileup_dict:
             continue
 
+        candidate_type = candidates_type_dict.get(pos)
         use_tensor_sample_mode = tensor_sample_mode and (
-                candidates_type_dict[pos] == 'homo_somatic' or candidates_type_dict[
-            pos] == 'hetero_somatic') and pos in truths_variant_dict
+                candidate_type == 'homo_somatic' or candidate_type == 'hetero_somatic') \
+            and pos in truths_variant_dict
         max_depth = param.tumor_matrix_depth_dict[platform] if is_tumor else param.normal_matrix_depth_dict[platform]
-        sorted_read_name_list = sorted_by_hap_read_name(pos, haplotag_dict, pileup_dict, hap_dict, max_depth,
-                                                        use_tensor_sample_mode)
+        sorted_read_name_infos = sorted_by_hap_read_name(pos, haplotag_dict, pileup_dict, hap_dict, max_depth,
+                                                         use_tensor_sample_mode)
         ref_seq = reference_sequence[
-                  pos - reference_start - flanking_base_num: pos - reference_start + flanking_base_num + 1].upper()
+                  pos - reference_start - flanking_base_num: pos - reference_start + flanking_base_num + 1]
 
         tensor, alt_info = generate_tensor(args=args,
                                            ctg_name=ctg_name,
                                            center_pos=pos,
-                                           sorted_read_name_list=sorted_read_name_list,
+                                           sorted_read_name_infos=sorted_read_name_infos,
                                            pileup_dict=pileup_dict,
                                            ref_seq=ref_seq,
                                            reference_sequence=reference_sequence,
@@ -962,11 +1065,20 @@ def create_tensor(args):
         if not tensor:
             continue
 
-        tensor_can_fp.stdin.write(tensor)
-        tensor_can_fp.stdin.write("\n")
+        # batch rows and flush in large blocks instead of one write call per tensor
+        tensor_buffer.append(tensor)
+        tensor_buffer.append("\n")
+        tensor_buffer_len += len(tensor) + 1
+        if tensor_buffer_len >= WRITE_BUFFER_SIZE:
+            tensor_can_fp.stdin.write("".join(tensor_buffer))
+            tensor_buffer.clear()
+            tensor_buffer_len = 0
         if alt_fn:
             alt_fp.stdin.write('\t'.join([ctg_name + ' ' + str(pos), alt_info]) + '\n')
 
+    if tensor_buffer:
+        tensor_can_fp.stdin.write("".join(tensor_buffer))
+
     samtools_mpileup_process.stdout.close()
     samtools_mpileup_process.wait()
 
@@ -974,6 +1086,8 @@ def create_tensor(args):
         tensor_can_fp.stdin.close()
         tensor_can_fp.wait()
         tensor_can_fpo.close()
+    else:
+        tensor_can_fp.close()
 
     if alt_fn:
         alt_fp.stdin.close()
@@ -40,7 +40,7 @@ from collections import Counter, defaultdict
 import shared.param as param
 from shared.vcf import VcfReader, VcfWriter
 from shared.utils import subprocess_popen, file_path_from, region_from, \
-    reference_sequence_from, str2bool
+    reference_sequence_from, str2bool, contig_length_from
 from shared.interval_tree import bed_tree_from, is_region_in
 
 logging.basicConfig(format='%(message)s', level=logging.INFO)
@@ -236,15 +236,7 @@ def extract_pair_candidates(args):
             ctg_start = bed_start + 1 + chunk_size * chunk_id  # 0-base to 1-base
             ctg_end = ctg_start + chunk_size
         else:
-            contig_length = 0
-            with open(fai_fn, 'r') as fai_fp:
-                for row in fai_fp:
-                    columns = row.strip().split("\t")
-
-                    contig_name = columns[0]
-                    if contig_name != ctg_name:
-                        continue
-                    contig_length = int(columns[1])
+            contig_length = contig_length_from(fai_fn, ctg_name)
             chunk_size = contig_length // chunk_num + 1 if contig_length % chunk_num else contig_length // chunk_num
             ctg_start = chunk_size * chunk_id  # 0-base to 1-base
             ctg_end = ctg_start + chunk_size
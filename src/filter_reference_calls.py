@@ -29,82 +29,288 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import os
-import shlex
+import concurrent.futures
 
-from sys import stderr
-from subprocess import Popen
-from subprocess import PIPE
 from argparse import ArgumentParser
 from collections import defaultdict
 
-from shared.interval_tree import bed_tree_from, is_region_in
-
-
-def subprocess_popen(args, stdin=None, stdout=PIPE, stderr=stderr, bufsize=8388608):
-    return Popen(args, stdin=stdin, stdout=stdout, stderr=stderr, bufsize=bufsize, universal_newlines=True)
+from shared.interval_tree import bed_tree_from, is_region_in, interval_at
+from shared.utils import gzip_byte_lines_from, gzip_bytes_from, is_file_exists
+
+import numpy as np
+
+try:
+    from numba import njit
+except ModuleNotFoundError:
+    njit = None
+
+try:
+    import pysam
+except ModuleNotFoundError:
+    pysam = None
+
+
+if njit is not None:
+    @njit(cache=True)
+    def _find_line_offsets(buf):
+        """
+        Return the int64 start offsets of all lines in a uint8 buffer, with the
+        buffer length appended as a sentinel.
+        """
+        n = buf.shape[0]
+        count = 1
+        for i in range(n):
+            if buf[i] == 10:  # '\n'
+                count += 1
+        offsets = np.empty(count + 1, dtype=np.int64)
+        offsets[0] = 0
+        j = 1
+        for i in range(n):
+            if buf[i] == 10:
+                offsets[j] = i + 1
+                j += 1
+        offsets[j] = n
+        return offsets
+
+    @njit(cache=True)
+    def _parse_vcf_rows(buf, offsets, ctg_bytes):
+        """
+        Scan a decompressed VCF held in a uint8 buffer and collect, for rows on
+        the target contig, the 1-based position of every variant plus the
+        position and REF/ALT field offsets of every '1/1'-genotyped variant.
+        """
+        variant_pos = np.empty(1024, dtype=np.int64)
+        homo_rows = np.empty((1024, 5), dtype=np.int64)  # pos, ref off/len, alt off/len
+        variant_num, homo_num = 0, 0
+        ctg_len = ctg_bytes.shape[0]
+        field_start = np.empty(10, dtype=np.int64)
+        field_end = np.empty(10, dtype=np.int64)
+        for k in range(offsets.shape[0] - 1):
+            s, e = offsets[k], offsets[k + 1]
+            if e > s and buf[e - 1] == 10:  # '\n'
+                e -= 1
+            if e > s and buf[e - 1] == 13:  # '\r'
+                e -= 1
+            if s >= e or buf[s] == 35:  # '#'
+                continue
+
+            # locate the tab-delimited fields 0..9 (CHROM..first sample)
+            field_idx = 0
+            fs = s
+            for p in range(s, e + 1):
+                if p == e or buf[p] == 9:  # '\t'
+                    field_start[field_idx] = fs
+                    field_end[field_idx] = p
+                    field_idx += 1
+                    fs = p + 1
+                    if field_idx == 10:
+                        break
+            if field_idx < 10:
+                continue
+
+            if field_end[0] - field_start[0] != ctg_len:
+                continue
+            is_target_ctg = True
+            for i in range(ctg_len):
+                if buf[field_start[0] + i] != ctg_bytes[i]:
+                    is_target_ctg = False
+                    break
+            if not is_target_ctg:
+                continue
+
+            pos = 0
+            for p in range(field_start[1], field_end[1]):
+                pos = pos * 10 + (buf[p] - 48)  # '0'
+
+            if variant_num == variant_pos.shape[0]:
+                new_variant_pos = np.empty(variant_num * 2, dtype=np.int64)
+                new_variant_pos[:variant_num] = variant_pos
+                variant_pos = new_variant_pos
+            variant_pos[variant_num] = pos
+            variant_num += 1
+
+            # homozygous iff the leading GT of the sample column is 1/1 or 1|1;
+            # a three-byte compare settles almost every row, the digit parser
+            # only runs for the rare multi-digit alleles
+            s9, e9 = field_start[9], field_end[9]
+            is_homo = False
+            need_generic = False
+            if e9 - s9 >= 2 and buf[s9] == 49:  # '1'
+                prefix_match = e9 - s9 >= 3 and (buf[s9 + 1] == 47 or buf[s9 + 1] == 124) \
+                    and buf[s9 + 2] == 49  # '/' '|' '1'
+                if prefix_match and (e9 - s9 == 3 or buf[s9 + 3] == 58):  # ':'
+                    is_homo = True
+                elif prefix_match or 48 <= buf[s9 + 1] <= 57:  # e.g. 1/11 or 11/...
+                    need_generic = True
+            if need_generic:
+                g1, g2 = -1, -1
+                p = s9
+                while p < e9 and 48 <= buf[p] <= 57:
+                    g1 = max(g1, 0) * 10 + (buf[p] - 48)
+                    p += 1
+                if p < e9 and (buf[p] == 47 or buf[p] == 124):  # '/' '|'
+                    p += 1
+                    while p < e9 and 48 <= buf[p] <= 57:
+                        g2 = max(g2, 0) * 10 + (buf[p] - 48)
+                        p += 1
+                is_homo = g1 == 1 and g2 == 1
+            if is_homo:
+                if homo_num == homo_rows.shape[0]:
+                    new_homo_rows = np.empty((homo_num * 2, 5), dtype=np.int64)
+                    new_homo_rows[:homo_num] = homo_rows
+                    homo_rows = new_homo_rows
+                homo_rows[homo_num, 0] = pos
+                homo_rows[homo_num, 1] = field_start[3]
+                homo_rows[homo_num, 2] = field_end[3] - field_start[3]
+                homo_rows[homo_num, 3] = field_start[4]
+                homo_rows[homo_num, 4] = field_end[4] - field_start[4]
+                homo_num += 1
+        return variant_pos[:variant_num], homo_rows[:homo_num]
 
 
 def vcf_reader(vcf_fn, contig_name, bed_tree=None):
     homo_variant_set = set()
     variant_set = set()
     homo_variant_info = defaultdict()
-    unzip_process = subprocess_popen(shlex.split("gzip -fdc %s" % (vcf_fn)))
-    for row in unzip_process.stdout:
-        row = row.rstrip()
-        if row[0] == '#':
-            continue
-        columns = row.strip().split('\t')
 
-        ctg_name = columns[0]
-        if contig_name and contig_name != ctg_name:
+    # with a tabix/CSI index the contig block is reachable by a BGZF seek,
+    # no need to decompress the whole file
+    if pysam is not None and contig_name is not None and \
+            (is_file_exists(vcf_fn, '.tbi') or is_file_exists(vcf_fn, '.csi')):
+        variant_file = pysam.VariantFile(vcf_fn)
+        try:
+            records = variant_file.fetch(contig_name)
+        except ValueError:
+            records = ()
+        for record in records:
+            pos = record.pos
+            if bed_tree and not is_region_in(tree=bed_tree, contig_name=contig_name, region_start=pos):
+                continue
+            if record.samples[0]['GT'] == (1, 1):
+                homo_variant_set.add(pos)
+                homo_variant_info[pos] = (record.ref, ','.join(record.alts) if record.alts else '.')
+            variant_set.add(pos)
+        variant_file.close()
+        return homo_variant_set, homo_variant_info, variant_set
+
+    if njit is not None and contig_name is not None:
+        raw = gzip_bytes_from(vcf_fn)
+        buf = np.frombuffer(raw, dtype=np.uint8)
+        offsets = _find_line_offsets(buf)
+        ctg_bytes = np.frombuffer(contig_name.encode('ascii'), dtype=np.uint8)
+        variant_pos, homo_rows = _parse_vcf_rows(buf, offsets, ctg_bytes)
+        for pos in variant_pos:
+            pos = int(pos)
+            if bed_tree and not is_region_in(tree=bed_tree, contig_name=contig_name, region_start=pos):
+                continue
+            variant_set.add(pos)
+        for row_idx in range(homo_rows.shape[0]):
+            pos = int(homo_rows[row_idx, 0])
+            if pos not in variant_set:
+                continue
+            ref_start, ref_len = int(homo_rows[row_idx, 1]), int(homo_rows[row_idx, 2])
+            alt_start, alt_len = int(homo_rows[row_idx, 3]), int(homo_rows[row_idx, 4])
+            ref_base = raw[ref_start:ref_start + ref_len].decode('ascii')
+            alt_base = raw[alt_start:alt_start + alt_len].decode('ascii')
+            homo_variant_set.add(pos)
+            homo_variant_info[pos] = (ref_base, alt_base)
+        return homo_variant_set, homo_variant_info, variant_set
+
+    # byte-mode fallback: only the REF/ALT slices actually kept are decoded
+    target_ctg = contig_name.encode('ascii') if contig_name else None
+    seen_target_ctg = False
+    for row in gzip_byte_lines_from(vcf_fn):
+        if not row or row[:1] == b'#':
             continue
+        if target_ctg is not None:
+            if row[:row.find(b'\t')] != target_ctg:
+                # VCFs are contig-sorted, stop once past the target block
+                if seen_target_ctg:
+                    break
+                continue
+            seen_target_ctg = True
+        columns = row.rstrip().split(b'\t')
+
         pos = int(columns[1])
-        ref_base = columns[3]
-        alt_base = columns[4]
         if bed_tree and not is_region_in(tree=bed_tree, contig_name=contig_name, region_start=pos):
             continue
 
-        genotype_info = columns[9].split(':')
-        genotype = genotype_info[0]
-        g1, g2 = genotype.replace('|', "/").split('/')
-        if g1 == "1" and g2 == "1":
+        genotype = columns[9].split(b':', 1)[0]
+        if genotype == b'1/1' or genotype == b'1|1':
             homo_variant_set.add(pos)
-            homo_variant_info[pos] = (ref_base, alt_base)
+            homo_variant_info[pos] = (columns[3].decode('ascii'), columns[4].decode('ascii'))
         variant_set.add(pos)
     return homo_variant_set, homo_variant_info, variant_set
 
 
+def _decode_af_file(f, output_alt, bed_tree, contig_name, min_depth):
+    import pandas as pd
+    if not os.path.exists(f):
+        print('{} not exist'.format(f))
+    if output_alt:
+        # keep the raw row, it is written out verbatim downstream
+        alt_info_dict = {}
+        for row in open(f):
+            if row.count('\t') < 4:
+                continue
+            pos = row.split('\t', 2)[1]
+            alt_info_dict[int(pos)] = row
+        return alt_info_dict
+    try:
+        df = pd.read_csv(f, sep=r'\s+', header=None, usecols=[1, 3], dtype=np.int64, engine='c')
+    except pd.errors.EmptyDataError:
+        return np.empty(0, dtype=np.int64)
+    positions = df[1].to_numpy()
+    positions = positions[df[3].to_numpy() >= min_depth]
+    if bed_tree:
+        # consecutive positions usually fall in the same bed interval, so a
+        # one-slot interval cache short-circuits most tree queries
+        cached_begin, cached_end = -1, -1
+        kept_positions = []
+        for pos in positions.tolist():
+            if cached_begin <= pos < cached_end:
+                kept_positions.append(pos)
+                continue
+            interval = interval_at(bed_tree, contig_name, pos)
+            if interval is not None:
+                cached_begin, cached_end = interval
+                kept_positions.append(pos)
+        positions = np.array(kept_positions, dtype=np.int64)
+    return positions
+
+
 def decode_af(input_dir, file_list, output_depth=False, output_alt=False, bed_tree=None, contig_name=None):
-    af_dict = defaultdict(float)
     alt_info_dict = defaultdict()
-    pos_set = set()
-    for f in file_list:
-        f = os.path.join(input_dir, f)
-        if not os.path.exists(f):
-            print('{} not exist'.format(f))
-        for row in open(f):
-            if output_alt:
-                columns = row.rstrip().split('\t')
-                if len(columns) < 5:
-                    continue
-                pos = columns[1]
-
-                af = columns[4].split(',')[0]
-                alt_info_dict[int(pos)] = row
-                af_dict[int(pos)] = float(af)
-            else:
-                columns = row.rstrip().split()
-                pos = columns[1]
-                depth = columns[3]
-                if bed_tree and not is_region_in(bed_tree, contig_name, int(pos)):
-                    continue
-                min_depth = 4
-                if int(depth) < min_depth:
-                    continue
-                pos_set.add(int(pos))
+    min_depth = 4
+    file_paths = [os.path.join(input_dir, f) for f in file_list]
+    # per-file parses are independent and I/O-bound, thread them when there
+    # are enough files to amortize the pool
+    if len(file_paths) > 8:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as exec:
+            results = list(exec.map(
+                lambda f: _decode_af_file(f, output_alt, bed_tree, contig_name, min_depth), file_paths))
+    else:
+        results = [_decode_af_file(f, output_alt, bed_tree, contig_name, min_depth) for f in file_paths]
     if output_alt:
+        for file_alt_info_dict in results:
+            alt_info_dict.update(file_alt_info_dict)
         return alt_info_dict
-    return pos_set
+    results = [positions for positions in results if positions.shape[0] > 0]
+    if not results:
+        return set()
+    return set(np.unique(np.concatenate(results)).tolist())
+
+
+def _write_rows(fp, rows):
+    # join in bounded batches so no single join holds the whole output
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == 4096:
+            fp.write(''.join(batch))
+            batch.clear()
+    if batch:
+        fp.write(''.join(batch))
 
 
 def filter_ref(args):
@@ -128,11 +334,24 @@ def filter_ref(args):
     normal_unified_vcf_reader.read_vcf()
     normal_unified_variant_dict = normal_unified_vcf_reader.variant_dict
 
-    # file_list = os.listdir(normal_alt_dir)
-    normal_file_list = [f for f in os.listdir(normal_alt_dir) if
-                        "_" + contig_name + "_" in f and f.startswith(normal_sample)]
-    tumor_file_list = [f for f in os.listdir(tumor_alt_dir) if
-                       "_" + contig_name + "_" in f and f.startswith(tumor_sample)]
+    # partition the per-contig files in a single scandir pass per directory
+    needle = "_" + contig_name + "_"
+    normal_file_list, tumor_file_list = [], []
+    with os.scandir(normal_alt_dir) as dir_it:
+        for entry in dir_it:
+            name = entry.name
+            if needle not in name:
+                continue
+            if name.startswith(normal_sample):
+                normal_file_list.append(name)
+            if normal_alt_dir == tumor_alt_dir and name.startswith(tumor_sample):
+                tumor_file_list.append(name)
+    if normal_alt_dir != tumor_alt_dir:
+        with os.scandir(tumor_alt_dir) as dir_it:
+            for entry in dir_it:
+                name = entry.name
+                if needle in name and name.startswith(tumor_sample):
+                    tumor_file_list.append(name)
 
     bed_tree = bed_tree_from(bed_file_path=bed_fn, contig_name=contig_name)
     normal_alt_info_dict = decode_af(normal_alt_dir, normal_file_list, output_alt=True, bed_tree=bed_tree,
@@ -140,28 +359,30 @@ def filter_ref(args):
     tumor_alt_info_dict = decode_af(tumor_alt_dir, tumor_file_list, output_alt=True, bed_tree=bed_tree,
                                     contig_name=contig_name)
 
-    match_count = 0
-    normal_reference_cans_fp = open(os.path.join(reference_cans_dir, normal_sample + '_' + contig_name), 'w')
-    tumor_reference_cans_fp = open(os.path.join(reference_cans_dir, tumor_sample + '_' + contig_name), 'w')
-    pos_in_normal_truth = 0
-    pos_in_tumor_truth = 0
-    pos_in_normal_truth_and_tumor_truth = 0
+    normal_reference_cans_fp = open(os.path.join(reference_cans_dir, normal_sample + '_' + contig_name), 'w',
+                                    buffering=1 << 20)
+    tumor_reference_cans_fp = open(os.path.join(reference_cans_dir, tumor_sample + '_' + contig_name), 'w',
+                                   buffering=1 << 20)
     normal_reference_cans_fp.write("#{}\n".format(normal_sample))
     tumor_reference_cans_fp.write("#{}\n".format(tumor_sample))
-    for pos, alt_infos in sorted(list(tumor_alt_info_dict.items()), key=lambda x: x[0]):
-        if pos in normal_unified_variant_dict:
-            pos_in_normal_truth += 1
-            if pos in unified_variant_dict:
-                pos_in_normal_truth_and_tumor_truth += 1
-        # skip position in truth if not add truths
-        if pos in unified_variant_dict:
-            pos_in_tumor_truth += 1
-        if pos in unified_variant_dict and not add_truths:
-            continue
-        tumor_reference_cans_fp.write(alt_infos)
-        match_count += 1
-    for pos, alt_infos in sorted(list(normal_alt_info_dict.items()), key=lambda x: x[0]):
-        normal_reference_cans_fp.write(alt_infos)
+
+    # sorted-array joins instead of three dict membership tests per position
+    tumor_pos = np.sort(np.fromiter(tumor_alt_info_dict.keys(), dtype=np.int64, count=len(tumor_alt_info_dict)))
+    unified_pos = np.fromiter(unified_variant_dict.keys(), dtype=np.int64, count=len(unified_variant_dict))
+    normal_unified_pos = np.fromiter(normal_unified_variant_dict.keys(), dtype=np.int64,
+                                     count=len(normal_unified_variant_dict))
+    in_tumor_truth = np.isin(tumor_pos, unified_pos, assume_unique=True)
+    in_normal_truth = np.isin(tumor_pos, normal_unified_pos, assume_unique=True)
+    pos_in_normal_truth = int(in_normal_truth.sum())
+    pos_in_tumor_truth = int(in_tumor_truth.sum())
+    pos_in_normal_truth_and_tumor_truth = int((in_normal_truth & in_tumor_truth).sum())
+
+    # skip positions in truth if not add truths
+    keep_pos = tumor_pos if add_truths else tumor_pos[~in_tumor_truth]
+    match_count = int(keep_pos.shape[0])
+    _write_rows(tumor_reference_cans_fp, (tumor_alt_info_dict[pos] for pos in keep_pos.tolist()))
+    _write_rows(normal_reference_cans_fp, (normal_alt_info_dict[pos] for pos in
+                                           sorted(normal_alt_info_dict.keys())))
     normal_reference_cans_fp.close()
     tumor_reference_cans_fp.close()
 
@@ -150,9 +150,24 @@ def find_tumor_truth_in_normal(args):
     normal_unified_vcf_reader.read_vcf()
     normal_unified_variant_dict = normal_unified_vcf_reader.variant_dict
 
-    file_list = os.listdir(normal_alt_dir)
-    normal_file_list = [f for f in os.listdir(normal_alt_dir) if "_" + contig_name + "_" in f and f.startswith(normal_sample)]
-    tumor_file_list = [f for f in os.listdir(tumor_alt_dir) if "_" + contig_name + "_" in f and f.startswith(tumor_sample)]
+    # partition the per-contig files in a single scandir pass per directory
+    needle = "_" + contig_name + "_"
+    normal_file_list, tumor_file_list = [], []
+    with os.scandir(normal_alt_dir) as dir_it:
+        for entry in dir_it:
+            name = entry.name
+            if needle not in name:
+                continue
+            if name.startswith(normal_sample):
+                normal_file_list.append(name)
+            if normal_alt_dir == tumor_alt_dir and name.startswith(tumor_sample):
+                tumor_file_list.append(name)
+    if normal_alt_dir != tumor_alt_dir:
+        with os.scandir(tumor_alt_dir) as dir_it:
+            for entry in dir_it:
+                name = entry.name
+                if needle in name and name.startswith(tumor_sample):
+                    tumor_file_list.append(name)
 
     bed_tree = bed_tree_from(bed_file_path=bed_fn, contig_name=contig_name)
     normal_alt_info_dict = decode_af(normal_alt_dir, normal_file_list, output_alt=True, bed_tree=bed_tree, contig_name=contig_name)
@@ -31,11 +31,13 @@
 import shlex
 import os
 import sys
+import array
+import heapq
 from argparse import ArgumentParser, SUPPRESS
 from collections import defaultdict
 from subprocess import run
 
-from shared.utils import subprocess_popen
+from shared.utils import subprocess_popen, is_file_exists
 
 def select_hetero_snp_for_phasing(args):
 
@@ -44,86 +46,109 @@ def select_hetero_snp_for_phasing(args):
     var_pct_full = args.var_pct_full
     contig_name = args.ctg_name
     output_folder = args.output_folder
-    variant_dict = defaultdict(str)
+    variant_dict = {}
     tumor_variant_dict = defaultdict(str)
-    normal_qual_dict = defaultdict(int)
-    tumor_qual_dict = defaultdict(int)
+    # parallel primitive arrays instead of dicts of boxed floats
+    normal_pos_array = array.array('i')
+    normal_qual_array = array.array('f')
+    tumor_pos_array = array.array('i')
+    tumor_qual_array = array.array('f')
     header = []
 
-    normal_unzip_process = subprocess_popen(shlex.split("gzip -fdc %s" % (normal_vcf_fn)))
+    # a tabix range query reads only the target contig block instead of
+    # decompressing the whole file
+    use_tabix = contig_name and (is_file_exists(normal_vcf_fn, '.tbi') or is_file_exists(normal_vcf_fn, '.csi'))
+    normal_unzip_process = subprocess_popen(shlex.split(
+        "tabix -h %s %s" % (normal_vcf_fn, contig_name) if use_tabix else "gzip -fdc %s" % (normal_vcf_fn)))
     for row in normal_unzip_process.stdout:
-        row = row.rstrip()
         if row[0] == '#':
-            header.append(row + '\n')
+            header.append(row)
             continue
-        columns = row.strip().split()
+        # maxsplit stops after the first sample column, only the fields used get allocated
+        columns = row.split('\t', 9)
         ctg_name = columns[0]
         if contig_name and contig_name != ctg_name:
             continue
-        pos = int(columns[1])
         ref_base = columns[3]
         alt_base = columns[4]
-        genotype = columns[9].split(':')[0].replace('|', '/')
-
         if len(ref_base) == 1 and len(alt_base) == 1:
+            sample_column = columns[9]
+            gt_end = sample_column.find(':')
+            genotype = (sample_column[:gt_end] if gt_end != -1 else sample_column.rstrip()).replace('|', '/')
             if genotype == '0/1' or genotype == '1/0':
+                pos = int(columns[1])
                 qual = float(columns[5])
-                normal_qual_dict[pos] = qual
-                variant_dict[pos] = [ref_base, alt_base, qual, row]
+                normal_pos_array.append(pos)
+                normal_qual_array.append(qual)
+                # single-char strings are interned, a 2-tuple is all the lookup needs
+                variant_dict[pos] = (ref_base, alt_base)
 
-    intersect_pos_set = set()
+    # tumor VCF rows arrive position-sorted, so insertion order is sorted order
+    intersect_pos_list = []
     hetero_snp_not_found_in_tumor = 0
     hetero_snp_not_match_in_tumor = 0
-    tumor_unzip_process = subprocess_popen(shlex.split("gzip -fdc %s" % (tumor_vcf_fn)))
+    use_tabix = contig_name and (is_file_exists(tumor_vcf_fn, '.tbi') or is_file_exists(tumor_vcf_fn, '.csi'))
+    tumor_unzip_process = subprocess_popen(shlex.split(
+        "tabix -h %s %s" % (tumor_vcf_fn, contig_name) if use_tabix else "gzip -fdc %s" % (tumor_vcf_fn)))
     for row in tumor_unzip_process.stdout:
-        row = row.rstrip()
         if row[0] == '#':
             continue
-        columns = row.strip().split()
+        columns = row.split('\t', 9)
         ctg_name = columns[0]
         if contig_name and contig_name != ctg_name:
             continue
-        pos = int(columns[1])
         ref_base = columns[3]
         alt_base = columns[4]
-        genotype = columns[9].split(':')[0].replace('|', '/')
-
         if len(ref_base) == 1 and len(alt_base) == 1:
+            sample_column = columns[9]
+            gt_end = sample_column.find(':')
+            genotype = (sample_column[:gt_end] if gt_end != -1 else sample_column.rstrip()).replace('|', '/')
             if genotype == '0/1' or genotype == '1/0':
+                pos = int(columns[1])
                 qual = float(columns[5])
-                tumor_qual_dict[pos] = qual
+                tumor_pos_array.append(pos)
+                tumor_qual_array.append(qual)
                 if pos not in variant_dict and qual < args.min_qual:
                     hetero_snp_not_found_in_tumor += 1
                     continue
                 if pos in variant_dict:
-                    tumor_ref_base, tumor_alt_base = variant_dict[pos][:2]
+                    tumor_ref_base, tumor_alt_base = variant_dict[pos]
                     if tumor_ref_base != ref_base or tumor_alt_base != alt_base:
                         hetero_snp_not_match_in_tumor += 1
                         continue
-                tumor_variant_dict[pos] = row
-                intersect_pos_set.add(pos)
+                tumor_variant_dict[pos] = row.rstrip()
+                intersect_pos_list.append(pos)
+
+    def low_qual_set_from(pos_array, qual_array, low_qual_count):
+        # bottom low_qual_count positions by qual, an O(n log k) heap selection
+        # instead of a full sort, and no numpy so the step stays pypy3-friendly
+        if not low_qual_count:
+            return set()
+        return set(pos for _, pos in heapq.nsmallest(low_qual_count, zip(qual_array, pos_array)))
 
-    normal_low_qual_set = set([item[0] for item in sorted(normal_qual_dict.items(), key=lambda x: x[1])[:int(var_pct_full * len(normal_qual_dict))]])
-    tumor_low_qual_set = set([item[0] for item in sorted(tumor_qual_dict.items(), key=lambda x: x[1])[:int(var_pct_full * len(tumor_qual_dict))]])
+    normal_low_qual_set = low_qual_set_from(normal_pos_array, normal_qual_array,
+                                            int(var_pct_full * len(normal_pos_array)))
+    tumor_low_qual_set = low_qual_set_from(tumor_pos_array, tumor_qual_array,
+                                           int(var_pct_full * len(tumor_pos_array)))
 
 
-    pass_variant_dict = defaultdict()
+    pass_variant_dict = {}
     low_qual_count = 0
-    for pos in intersect_pos_set:
+    for pos in intersect_pos_list:
         if pos in normal_low_qual_set or pos in tumor_low_qual_set:
             low_qual_count += 1
             continue
         pass_variant_dict[pos] = tumor_variant_dict[pos]
 
-    pro = len(pass_variant_dict) / max(len(tumor_qual_dict), 1.0)
-    print ('[INFO] Total HET SNP calls selected: {}: {}, not found:{}, not match:{}, low_qual_count:{}. Total normal:{} Total tumor:{}, pro: {}'.format(contig_name, len(pass_variant_dict), hetero_snp_not_found_in_tumor, hetero_snp_not_match_in_tumor, low_qual_count, len(normal_qual_dict), len(tumor_qual_dict), pro))
+    pro = len(pass_variant_dict) / max(len(tumor_pos_array), 1.0)
+    print ('[INFO] Total HET SNP calls selected: {}: {}, not found:{}, not match:{}, low_qual_count:{}. Total normal:{} Total tumor:{}, pro: {}'.format(contig_name, len(pass_variant_dict), hetero_snp_not_found_in_tumor, hetero_snp_not_match_in_tumor, low_qual_count, len(normal_pos_array), len(tumor_pos_array), pro))
 
     if not os.path.exists(output_folder):
         return_code = run("mkdir -p {}".format(output_folder), shell=True)
     f = open(os.path.join(output_folder, '{}.vcf'.format(contig_name)), 'w')
     f.write(''.join(header))
-    for key, row in sorted(pass_variant_dict.items(), key=lambda x: x[0]):
-        f.write(row +'\n')
+    for row in pass_variant_dict.values():
+        f.write(row + '\n')
     f.close()
 
 
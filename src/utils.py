@@ -29,10 +29,11 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import os
+import shutil
 import sys
 from os.path import isfile, abspath
 from sys import exit, stderr
-from subprocess import check_output, PIPE, Popen
+from subprocess import PIPE, Popen
 import argparse
 import shlex
 from subprocess import PIPE
@@ -79,39 +80,36 @@ def legal_range_from(param_name, x, min_num=None, max_num=None, exit_out_of_rang
     return
 
 def file_path_from(file_name, suffix="", exit_on_not_found=False, sep=""):
-    if is_file_exists(file_name, suffix):
-        return abspath(file_name + suffix)
+    file_path = file_name + suffix if isinstance(file_name, str) and isinstance(suffix, str) else None
+    if file_path is not None and isfile(file_path):
+        return abspath(file_path)
     #allow fn.bam.bai->fn.bai fn.fa.fai->fn.fai
     elif sep != "" and len(sep) == 1:
-        file_name_remove_suffix = sep.join(file_name.split(sep)[:-1])
-        if is_file_exists(file_name_remove_suffix, suffix):
-            return abspath(file_name_remove_suffix + suffix)
+        file_path_remove_suffix = sep.join(file_name.split(sep)[:-1]) + suffix
+        if isfile(file_path_remove_suffix):
+            return abspath(file_path_remove_suffix)
     if exit_on_not_found:
         exit(log_error("[ERROR] file %s not found" % (file_name + suffix)))
     return None
 
 def folder_path_from(folder_name, create_not_found=True, exit_on_not_found=False):
+    absolute_folder_path = abspath(folder_name) if isinstance(folder_name, str) else None
     if is_folder_exists(folder_name):
-        return abspath(folder_name)
+        return absolute_folder_path
     if exit_on_not_found:
         exit(log_error("[ERROR] folder %s not found" % (folder_name)))
     if create_not_found:
         if not os.path.exists(folder_name):
-            os.makedirs(abspath(folder_name))
+            os.makedirs(absolute_folder_path)
             print("[INFO] Create folder %s" % (folder_name), file=stderr)
-            return abspath(folder_name)
+            return absolute_folder_path
     return None
 
 
 def is_command_exists(command):
     if not isinstance(command, str):
         return False
-
-    try:
-        check_output("which %s" % (command), shell=True)
-        return True
-    except:
-        return False
+    return shutil.which(command) is not None
 
 
 def executable_command_string_from(command_to_execute, exit_on_not_found=False):
@@ -122,8 +120,9 @@ def executable_command_string_from(command_to_execute, exit_on_not_found=False):
     return None
 
 
-def subprocess_popen(args, stdin=None, stdout=PIPE, stderr=stderr, bufsize=8388608):
-    return Popen(args, stdin=stdin, stdout=stdout, stderr=stderr, bufsize=bufsize, universal_newlines=True)
+def subprocess_popen(args, stdin=None, stdout=PIPE, stderr=stderr, bufsize=8388608, text=True):
+    # pass text=False for high-throughput pipes to skip the per-line decode
+    return Popen(args, stdin=stdin, stdout=stdout, stderr=stderr, bufsize=bufsize, universal_newlines=text)
 
 
 def str_none(v):
@@ -132,12 +131,15 @@ def str_none(v):
     if isinstance(v, str):
         return v
 
+_TRUE_STRING_SET = frozenset(('yes', 'true', 't', 'y', '1'))
+_FALSE_STRING_SET = frozenset(('no', 'false', 'f', 'n', '0'))
+
 def str2bool(v):
     if isinstance(v, bool):
        return v
-    if v.lower() in ('yes', 'true', 't', 'y', '1'):
+    if v.lower() in _TRUE_STRING_SET:
         return True
-    elif v.lower() in ('no', 'false', 'f', 'n', '0'):
+    elif v.lower() in _FALSE_STRING_SET:
         return False
     else:
         raise argparse.ArgumentTypeError('Boolean value expected.')
@@ -245,6 +247,6 @@ def samtools_view_process_from(
     region_str = ("%s:%d-%d" % (ctg_name, ctg_start, ctg_end)) if have_start_and_end_position else ctg_name
 
     return subprocess_popen(
-        shlex.split("%s view -F 2318 %s %s" % (samtools, bam_file_path, region_str))
+        shlex.split("%s view -F 2318 %s %s" % (samtools, bam_file_path, region_str)), text=False
     )
 